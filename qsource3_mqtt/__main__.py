@@ -1,7 +1,10 @@
 import logging
+import signal
 import time
 
-from .qsource3_mqtt_client import QSource3MQTTClient
+started = time.monotonic()  # the startup log includes the import time
+
+from .qsource3_mqtt_client import QSource3MQTTClient  # noqa: E402
 
 # Configure logging
 logging.basicConfig(
@@ -10,16 +13,15 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
-    client = QSource3MQTTClient("config.yaml")
+    client = QSource3MQTTClient("config.yaml", started=started)
+
+    # a service manager stops the client with SIGTERM, handled like Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     try:
-        while True:
-            client.main()
-            logger.info(
-                f"Main loop stopped. Disconnected status: {client.disconnected}"
-            )
-            logger.info("Attempt to reconnect in 5 seconds ...")
-            time.sleep(5)
+        client.run_forever()
     except KeyboardInterrupt:
-        if client is not None:
-            client.stop()
+        pass
+    finally:
+        # stops the device workers and writes the pending settings
+        client.stop()
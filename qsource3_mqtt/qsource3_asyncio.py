@@ -0,0 +1,61 @@
+import asyncio
+import logging
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioHelper:
+    """Drives a paho MQTT client from an asyncio event loop.
+
+    The socket is watched with `add_reader`/`add_writer` instead of `select`,
+    so reads and writes are served as soon as the socket is ready.
+    Publishes from the device worker threads register the writer through
+    `call_soon_threadsafe`.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc_task = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        logger.debug("Socket opened")
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        logger.debug("Socket closed")
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+            self.misc_task = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        # may be called from a device worker thread
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+    def close(self):
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+            self.misc_task = None
+        sock = self.client.socket()
+        if sock:
+            self.loop.remove_reader(sock)
+            self.loop.remove_writer(sock)
@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+
+
+class QSource3WriteError(ConnectionError):
+    """Raised when register writes of a batch failed.
+
+    `errors` maps each failed register to its error, `unwritten` lists the
+    registers of the batch that were not written, the failed ones included.
+    """
+
+    def __init__(self, errors, unwritten=None):
+        self.errors = errors
+        self.unwritten = list(errors) if unwritten is None else unwritten
+        message = "Register writes failed: " + ", ".join(
+            f"{name}: {error}" for name, error in errors.items()
+        )
+        if len(self.unwritten) > len(errors):
+            message += f" (not written: {', '.join(self.unwritten)})"
+        super().__init__(message)
+
+
+class BatchingDriver:
+    """Wraps a QSource3 driver and defers the register writes made inside `batch()`.
+
+    Inside the context, `set_*` calls and attribute writes are queued in
+    order instead of sent. A later write to the same register replaces the
+    queued value and moves to the end of the queue, unless a range switch
+    was queued in between: the earlier value belongs to the previous range
+    and is kept. Queued writes take positional arguments only. On
+    exit the queue is sent back-to-back: in one `write_registers(writes)`
+    call if the driver supports pipelined writes, else one write after the
+    other. The errors of the failed registers are raised together as a
+    QSource3WriteError. Written one after the other, the first failure stops
+    the batch, the later writes may depend on it (e.g. a range switch). Reading
+    from the driver inside a batch sends the queued writes first. Batches
+    can be nested, the outermost one sends the writes. `capture()` records
+    the writes made inside it without sending them, they can be sent later
+    with `write()`.
+    """
+
+    def __init__(self, driver):
+        object.__setattr__(self, "_driver", driver)
+        object.__setattr__(self, "_writes", [])
+        object.__setattr__(self, "_depth", 0)
+        object.__setattr__(self, "_capturing", False)
+
+    def batch(self):
+        return _Batch(self)
+
+    @contextmanager
+    def capture(self):
+        """Records the writes made inside the context instead of sending them.
+
+        The yielded list holds the (name, args) writes in order. Reads inside
+        the context go to the device without sending the writes queued by an
+        enclosing batch.
+        """
+        saved = (self._writes, self._depth, self._capturing)
+        writes = []
+        object.__setattr__(self, "_writes", writes)
+        object.__setattr__(self, "_depth", self._depth + 1)
+        object.__setattr__(self, "_capturing", True)
+        try:
+            yield writes
+        finally:
+            for name, value in zip(("_writes", "_depth", "_capturing"), saved):
+                object.__setattr__(self, name, value)
+
+    def write(self, writes):
+        """Sends the (name, args) register writes, queues them inside a batch."""
+        if self._depth > 0:
+            for name, args in writes:
+                self._queue(name, args)
+            return
+        for name, args in writes:
+            self._write(name, args)
+
+    def flush(self):
+        """Sends the queued writes."""
+        writes = list(self._writes)
+        self._writes.clear()
+        if not writes:
+            return
+        try:
+            write_registers = self._driver.write_registers
+        except AttributeError:
+            from pyvisa import VisaIOError  # imported by the driver already
+
+            for idx, (name, args) in enumerate(writes):
+                try:
+                    self._write(name, args)
+                except (VisaIOError, ConnectionError) as e:
+                    unwritten = [name for name, _ in writes[idx:]]
+                    raise QSource3WriteError({name: e}, unwritten)
+            return
+        errors = write_registers(writes)
+        if errors:
+            raise QSource3WriteError(errors)
+
+    def _queue(self, name, args):
+        writes = self._writes
+        if name != "set_range":
+            for idx in range(len(writes) - 1, -1, -1):
+                if writes[idx][0] == "set_range":
+                    break  # the queued value is a write to the previous range
+                if writes[idx][0] == name:
+                    del writes[idx]
+                    break
+        writes.append((name, args))
+
+    def _write(self, name, args):
+        if name.startswith("set_"):
+            getattr(self._driver, name)(*args)
+        else:
+            setattr(self._driver, name, args[0])
+
+    def __getattr__(self, name):
+        if self._depth == 0:
+            return getattr(self._driver, name)
+        if name.startswith("set_"):
+
+            def write(*args, **kwargs):
+                if kwargs:
+                    # the pipelined (name, args) writes have no keyword arguments
+                    raise TypeError(f"Queued write {name} takes no keyword arguments")
+                self._queue(name, args)
+
+            return write
+        if not self._capturing:
+            self.flush()
+        return getattr(self._driver, name)
+
+    def __setattr__(self, name, value):
+        if self._depth == 0:
+            setattr(self._driver, name, value)
+        else:
+            self._queue(name, (value,))
+
+
+class _Batch:
+    __slots__ = ("driver",)
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        object.__setattr__(self.driver, "_depth", self.driver._depth + 1)
+        return self.driver
+
+    def __exit__(self, exc_type, exc, traceback):
+        depth = self.driver._depth - 1
+        object.__setattr__(self.driver, "_depth", depth)
+        if depth == 0:
+            # writes queued before an error are sent, as without a batch
+            self.driver.flush()
@@ -0,0 +1,132 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+ENCODINGS = ("json", "msgpack", "cbor", "struct")
+
+# packed status record: magic, version, bit mask of the present fields, fields
+STATUS_MAGIC = b"QS3"
+STATUS_VERSION = 1
+STATUS_FIELDS = (
+    ("range", "B"),
+    ("frequency", "d"),
+    ("rf_amp", "d"),
+    ("dc1", "d"),
+    ("dc2", "d"),
+    ("current", "d"),
+    ("mz", "d"),
+    ("is_dc_on", "?"),
+    ("is_rod_polarity_positive", "?"),
+    ("max_mz", "d"),
+)
+STATUS_STRUCT = struct.Struct("<3sBH" + "".join(code for _, code in STATUS_FIELDS))
+
+
+def check_encoding(encoding, allow_struct=False):
+    """Raises ValueError if `encoding` is unknown or its package is not installed."""
+    if encoding not in ENCODINGS or (encoding == "struct" and not allow_struct):
+        raise ValueError(f"Invalid payload encoding: {encoding}")
+    if encoding == "msgpack" and msgpack is None:
+        raise ValueError("The msgpack encoding requires the msgpack package")
+    if encoding == "cbor" and cbor2 is None:
+        raise ValueError("The cbor encoding requires the cbor2 package")
+
+
+def encode(payload, encoding="json"):
+    """Returns `payload` encoded as JSON text or as MessagePack, CBOR or struct bytes."""
+    if encoding == "msgpack":
+        return msgpack.packb(payload)
+    if encoding == "cbor":
+        return cbor2.dumps(payload)
+    if encoding == "struct":
+        return encode_status(payload)
+    return json.dumps(payload)
+
+
+def encode_response(value, sender_payload, encoding="json"):
+    """Encodes {"value": ..., "sender_payload": ...} around a `value` already encoded by `encode`.
+
+    Only the sender payload is encoded per request, the result equals the
+    encoding of the whole dictionary.
+    """
+    if encoding == "msgpack":
+        return b"".join(
+            (
+                b"\x82",  # map of two entries
+                msgpack.packb("value"),
+                value,
+                msgpack.packb("sender_payload"),
+                msgpack.packb(sender_payload),
+            )
+        )
+    if encoding == "cbor":
+        return b"".join(
+            (
+                b"\xa2",  # map of two entries
+                cbor2.dumps("value"),
+                value,
+                cbor2.dumps("sender_payload"),
+                cbor2.dumps(sender_payload),
+            )
+        )
+    return f'{{"value": {value}, "sender_payload": {json.dumps(sender_payload)}}}'
+
+
+def decode(data):
+    """Decodes a payload, detecting its encoding from the first byte.
+
+    Payloads are JSON objects, MessagePack or CBOR maps or packed status
+    records, whose first bytes do not overlap.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    if data.startswith(STATUS_MAGIC):
+        return decode_status(data)
+    first = data[0] if data else 0
+    if 0x80 <= first <= 0x8F or first in (0xDE, 0xDF):
+        if msgpack is None:
+            raise ValueError("Received a MessagePack payload, msgpack is not installed")
+        return msgpack.unpackb(data)
+    if 0xA0 <= first <= 0xBB or first == 0xBF:
+        if cbor2 is None:
+            raise ValueError("Received a CBOR payload, cbor2 is not installed")
+        return cbor2.loads(data)
+    return json.loads(data)
+
+
+def encode_status(status):
+    """Packs a (partial) status dictionary into the fixed status record."""
+    mask = 0
+    values = []
+    for bit, (name, code) in enumerate(STATUS_FIELDS):
+        value = status.get(name)
+        if value is None:
+            values.append(False if code == "?" else 0)
+        else:
+            mask |= 1 << bit
+            values.append(value)
+    return STATUS_STRUCT.pack(STATUS_MAGIC, STATUS_VERSION, mask, *values)
+
+
+def decode_status(data):
+    """Unpacks a status record into a dictionary of the fields present in it."""
+    try:
+        magic, version, mask, *values = STATUS_STRUCT.unpack(data)
+    except struct.error as e:  # a truncated record, like the other decoders
+        raise ValueError(f"Invalid status record: {e}")
+    if version != STATUS_VERSION:
+        raise ValueError(f"Unsupported status record version {version}")
+    return {
+        name: value
+        for bit, ((name, _), value) in enumerate(zip(STATUS_FIELDS, values))
+        if mask & (1 << bit)
+    }
@@ -0,0 +1,689 @@
+import logging
+import math
+import time
+from functools import partial, wraps
+from threading import Event
+
+from .qsource3_codec import check_encoding, encode, encode_response
+from .qsource3_logic import (
+    BATCH_PARAMETERS,
+    QSource3Logic,
+    QSource3NotConnectedException,
+    make_scan_points,
+)
+from .qsource3_metrics import QSource3Metrics
+from .qsource3_responses import QSource3ResponseCache
+from .qsource3_status import QSource3StatusFilter
+from .qsource3_telemetry import TELEMETRY_FIELDS, QSource3TelemetryBuffer
+from .qsource3_trigger import QSource3TriggerStream
+from .qsource3_worker import QSource3Worker
+
+logger = logging.getLogger(__name__)
+
+NUMBER = (int, float)
+
+
+class Command:
+    """Registered handler of a `<topic_base>/cmnd/<device_name>/<command>` topic."""
+
+    __slots__ = ("name", "handler", "value_types", "coalesced")
+
+    def __init__(self, name, handler, value_types, coalesced):
+        self.name = name
+        self.handler = handler
+        self.value_types = value_types
+        self.coalesced = coalesced
+
+    def validate(self, payload):
+        """Returns the error message for an invalid `payload`, None if it is valid."""
+        if not isinstance(payload, dict):
+            return f"Payload must be an object, not {payload!r}"
+        if self.value_types is not None and "value" in payload:
+            value = payload["value"]
+            types = self.value_types
+            if not isinstance(types, tuple):
+                types = (types,)
+            # bool is a subclass of int, but true is not a range or a number
+            if not isinstance(value, types) or (
+                isinstance(value, bool) and bool not in types
+            ):
+                return f"Invalid value for {self.name}: {value!r}"
+        return None
+
+
+# command name -> Command, filled by the @command decorator of QSource3Device
+COMMANDS = {}
+
+
+def command(name, value_types=None, coalesced=False):
+    """Registers the decorated QSource3Device method as the handler of command `name`.
+
+    A write ("value" in the payload) must be an instance of `value_types`,
+    None accepts any value. Queued writes of a `coalesced` command are merged
+    and its handler receives the payloads of the merged writes in `superseded`.
+    """
+
+    def register(handler):
+        COMMANDS[name] = Command(name, handler, value_types, coalesced)
+        return handler
+
+    return register
+
+
+def handle_connection_error(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        logger.debug(
+            f"Calling method: {method.__name__} with args: {args} and kwargs: {kwargs}"
+        )
+        try:
+            with self.metrics.timed(method.__name__):
+                result = method(self, *args, **kwargs)
+            logger.debug(f"Method {method.__name__} returned: {result}")
+            return result
+        except QSource3NotConnectedException as e:
+            self.metrics.inc("command_errors")
+            command = method.__name__.split("_")[1]  # Extract command from method name
+            logger.error(f"Connection error in method {method.__name__}: {e}")
+            self.publish_error(command, str(e))
+
+    return wrapper
+
+
+class QSource3Device:
+    """One QSource3 unit served over a shared MQTT connection.
+
+    Commands for `<topic_base>/cmnd/<device_name>/#` are handed to
+    `on_command` by the owning QSource3MQTTClient. Each device has its own
+    worker thread, so the serial I/O of several devices runs in parallel.
+    """
+
+    def __init__(self, owner, config):
+        self.owner = owner  # QSource3MQTTClient providing the MQTT connection
+        self.config = config
+        self.topic_base = config["topic_base"]
+        self.device_name = config["device_name"]
+        self.scan_running = False
+        self.scan_stop_event = Event()
+        # a larger scan is rejected before its points are built
+        self.scan_max_points = config.get("scan_max_points", 100000)
+        self.sim_running = False
+        self.sim_stop_event = Event()
+        self.status_pending = False
+        # encoding of the published payloads, the status may also be a packed struct
+        self.payload_encoding = config.get("payload_encoding", "json")
+        check_encoding(self.payload_encoding)
+        self.status_encoding = config.get("status_encoding", self.payload_encoding)
+        check_encoding(self.status_encoding, allow_struct=True)
+        self.metrics = QSource3Metrics()
+        # encoded parameter values of the query responses
+        self.response_cache = QSource3ResponseCache(
+            self.payload_encoding, metrics=self.metrics
+        )
+        self.status_filter = QSource3StatusFilter(
+            mode=config.get("status_mode", "full"),
+            fields=config.get("status_fields"),
+            deadbands=config.get("status_deadbands"),
+            heartbeat=config.get("status_heartbeat", 10000) / 1000,
+        )
+
+        # opt-in sampling of the RF amplitude, DC voltages and current while idle
+        self.telemetry = config.get("telemetry")
+        self.telemetry_buffer = None
+        if self.telemetry is not None:
+            self.telemetry_buffer = QSource3TelemetryBuffer(
+                fields=self.telemetry.get("fields", TELEMETRY_FIELDS),
+                capacity=self.telemetry.get("capacity", 10000),
+            )
+            self.next_sample_time = 0.0
+            self.telemetry_publish_time = time.monotonic()
+
+        # opt-in stream of the setpoints applied by scans and SIM programs
+        self.trigger = config.get("trigger")
+        self.trigger_stream = None
+        self.trigger_settling = None  # setpoint event waiting for its settle time
+        if self.trigger is not None:
+            self.trigger_stream = QSource3TriggerStream(
+                capacity=self.trigger.get("capacity", 10000)
+            )
+            self.trigger_publish_time = time.monotonic()
+
+        # all QSource3Logic calls run on the worker thread
+        self.worker = QSource3Worker(
+            name=f"qsource3-worker-{self.device_name}",
+            idle=self.sample_telemetry if self.telemetry is not None else None,
+        )
+
+        logic_options = {}
+        simulator = config.get("simulator")
+        if simulator is not None:
+            from .qsource3_simulator import SimulatedQSource3Driver
+
+            logger.info(f"Device {self.device_name} uses the simulated QSource3 driver")
+            logic_options["driver_factory"] = partial(
+                SimulatedQSource3Driver,
+                latency=simulator.get("latency", 0) / 1000,
+                failure_rate=simulator.get("failure_rate", 0),
+                seed=simulator.get("seed"),
+            )
+
+        self.qsource3 = QSource3Logic(
+            comport=config["qsource3_com_port"],
+            r0=float(config["r0"]),
+            on_connected=self.on_qsource3_connected,
+            number_of_ranges=config["number_of_ranges"],
+            settings_file=config["settings_file"],
+            poll_intervals=config.get("status_poll_intervals"),
+            settings_save_delay=config.get("settings_save_delay", 500),
+            connect_delay=config.get("connect_delay", 0),
+            connect_timeout=config.get("connect_timeout", 2000),
+            metrics=self.metrics,
+            **logic_options,
+        )
+        self.worker.start()
+
+        self.metrics.gauge("queue_depth", self.worker.pending)
+        self.metrics.gauge("coalesced", lambda: self.worker.coalesced)
+        self.metrics.gauge("connected", lambda: int(self.qsource3.is_connected()))
+        self.metrics.gauge("scan_running", lambda: int(self.scan_running))
+        if self.telemetry_buffer is not None:
+            buffer = self.telemetry_buffer
+            self.metrics.gauge("telemetry_buffered", buffer.__len__)
+            self.metrics.gauge("telemetry_dropped", lambda: buffer.dropped)
+        if self.trigger_stream is not None:
+            stream = self.trigger_stream
+            self.metrics.gauge("trigger_buffered", stream.__len__)
+            self.metrics.gauge("trigger_dropped", lambda: stream.dropped)
+
+        # connect while the client connects to the broker instead of on the
+        # first command or status request
+        if config.get("connect_on_start", True):
+            self.worker.submit(self.connect_on_start)
+
+    def publish(self, topic, payload, kind, retain=False, latest=False):
+        """Publishes through the owner with the QoS of message class `kind`."""
+        self.owner.publish(topic, payload, kind, retain=retain, latest=latest)
+        self.metrics.inc("mqtt_messages_out")
+
+    def on_command(self, name, payload):
+        """Validates the payload of command `name` and queues its handler."""
+        self.metrics.inc("mqtt_messages_in")
+        command = COMMANDS.get(name)
+        if command is None:
+            logger.warning(f"Unknown command {name} for device {self.device_name}")
+            return
+        error = command.validate(payload)
+        if error is not None:
+            logger.error(error)
+            self.publish_response(name, {"error": error}, payload)
+            return
+
+        if "value" in payload:
+            # any new command stops a running SIM program right away
+            self.sim_stop_event.set()
+            if name in ("scan", "sim"):
+                # a new scan or program or an abort request stops the running scan
+                self.scan_stop_event.set()
+                if not payload["value"].get("abort"):
+                    # the new run gets its stop event before it is queued, so a
+                    # command arriving while it waits in the queue stops it too
+                    stop_event = Event()
+                    if name == "scan":
+                        self.scan_stop_event = stop_event
+                    else:
+                        self.sim_stop_event = stop_event
+                    self.worker.submit(
+                        self.dispatch_command, command, payload, stop_event=stop_event
+                    )
+                    return
+
+        if "value" not in payload:
+            self.worker.submit_read(self.dispatch_command, command, payload)
+        elif command.coalesced:
+            self.worker.submit_coalesced(name, self.dispatch_command, command, payload)
+        else:
+            self.worker.submit(self.dispatch_command, command, payload)
+
+    def dispatch_command(self, command, payload, superseded=(), **kwargs):
+        """Runs the handler of `command`, `superseded` holds payloads of merged writes."""
+        if command.coalesced:
+            command.handler(self, payload, superseded)
+        else:
+            command.handler(self, payload, **kwargs)
+
+    # Define handlers for each command topic
+    @command("is_dc_on", bool, coalesced=True)
+    @handle_connection_error
+    def handle_is_dc_on(self, payload, superseded=()):
+        if "value" in payload:
+            self.response_cache.invalidate(self.qsource3.current_range)
+            self.qsource3.is_dc_on = payload["value"]
+        self.publish_parameter("is_dc_on", payload, superseded)
+
+    @command("is_rod_polarity_positive", bool, coalesced=True)
+    @handle_connection_error
+    def handle_is_rod_polarity_positive(self, payload, superseded=()):
+        if "value" in payload:
+            self.response_cache.invalidate(self.qsource3.current_range)
+            self.qsource3.is_rod_polarity_positive = payload["value"]
+        self.publish_parameter("is_rod_polarity_positive", payload, superseded)
+
+    @command("max_mz")
+    @handle_connection_error
+    def handle_max_mz(self, payload):
+        self.publish_parameter("max_mz", payload)
+
+    @command("calib_pnts_dc", list, coalesced=True)
+    @handle_connection_error
+    def handle_calib_pnts_dc(self, payload, superseded=()):
+        if "value" in payload:
+            self.response_cache.invalidate(self.qsource3.current_range)
+            self.qsource3.calib_pnts_dc = payload["value"]
+        self.publish_parameter("calib_pnts_dc", payload, superseded)
+
+    @command("calib_pnts_rf", list, coalesced=True)
+    @handle_connection_error
+    def handle_calib_pnts_rf(self, payload, superseded=()):
+        if "value" in payload:
+            self.response_cache.invalidate(self.qsource3.current_range)
+            self.qsource3.calib_pnts_rf = payload["value"]
+        self.publish_parameter("calib_pnts_rf", payload, superseded)
+
+    @command("dc_offst", NUMBER, coalesced=True)
+    @handle_connection_error
+    def handle_dc_offst(self, payload, superseded=()):
+        if "value" in payload:
+            self.response_cache.invalidate(self.qsource3.current_range)
+            self.qsource3.dc_offst = payload["value"]
+        self.publish_parameter("dc_offst", payload, superseded)
+
+    @command("range", int, coalesced=True)
+    @handle_connection_error
+    def handle_range(self, payload, superseded=()):
+        if "value" in payload:
+            self.qsource3.set_range(payload["value"])
+        self.publish_parameter("range", payload, superseded)
+
+    @command("mz", NUMBER, coalesced=True)
+    @handle_connection_error
+    def handle_mz(self, payload, superseded=()):
+        if "value" in payload:
+            self.qsource3.mz = payload["value"]
+        self.publish_response("mz", self.qsource3.mz, payload, superseded)
+
+    @command("batch", dict)
+    @handle_connection_error
+    def handle_batch(self, payload):
+        names = BATCH_PARAMETERS
+        if "value" in payload:
+            # the values get the type checks of their own commands
+            for name, value in payload["value"].items():
+                error = name in COMMANDS and COMMANDS[name].validate({"value": value})
+                if error:
+                    logger.error(f"Invalid batch payload {payload}: {error}")
+                    self.publish_response("batch", {"error": error}, payload)
+                    return
+            self.response_cache.invalidate()  # the batch may switch the range
+            try:
+                names = self.qsource3.apply_batch(payload["value"])
+            except (TypeError, ValueError) as e:
+                logger.error(f"Invalid batch payload {payload}: {e}")
+                self.publish_response("batch", {"error": str(e)}, payload)
+                return
+            except QSource3NotConnectedException:
+                raise  # published on the error topic
+            except Exception as e:
+                # apply_batch has dropped the connection, the next command
+                # restores the previous settings
+                logger.exception(f"Batch {payload} failed")
+                self.publish_response("batch", {"error": str(e)}, payload)
+                return
+        self.publish_response("batch", self.qsource3.get_parameters(names), payload)
+
+    @command("scan", dict)
+    def handle_scan(self, payload, stop_event=None):
+        if "value" not in payload:
+            state = "running" if self.scan_running else "idle"
+            self.publish_response("scan", {"state": state}, payload)
+            return
+
+        value = payload["value"]
+        if isinstance(value, dict) and value.get("abort"):
+            return  # the running scan was already stopped by on_message
+
+        try:
+            mz_values, dwell = self.parse_scan(value)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Invalid scan payload {payload}: {e}")
+            self.publish_response("scan", {"state": "error", "error": str(e)}, payload)
+            return
+
+        # the stopped scan or program has returned before this job runs, the
+        # stop event of on_command keeps it from running nested in their dwell
+        self.run_scan(mz_values, dwell, payload, stop_event or Event())
+
+    def parse_scan(self, value):
+        """Returns the list of m/z points and the dwell time in seconds of a scan request."""
+        if "mz_list" in value:
+            if len(value["mz_list"]) > self.scan_max_points:
+                raise ValueError(
+                    f"Scan has more than {self.scan_max_points} points: {len(value['mz_list'])}"
+                )
+            mz_values = [float(mz) for mz in value["mz_list"]]
+            if not all(math.isfinite(mz) for mz in mz_values):
+                raise ValueError(f"Scan m/z values must be finite: {value['mz_list']}")
+        else:
+            mz_values = make_scan_points(
+                float(value["start"]),
+                float(value["stop"]),
+                float(value["step"]),
+                self.scan_max_points,
+            )
+        if not mz_values:
+            raise ValueError("Scan has no points")
+        dwell = float(value.get("dwell", 0)) / 1000
+        # an infinite dwell would never end, a NaN dwell at once
+        if not math.isfinite(dwell) or dwell < 0:
+            raise ValueError(f"Invalid dwell time: {value.get('dwell')}")
+        return mz_values, dwell
+
+    def run_scan(self, mz_values, dwell, payload, stop_event):
+        count = len(mz_values)
+
+        def on_point(idx, mz, applied):
+            self.record_trigger(mz, applied)
+            self.publish_response(
+                "scan",
+                {"state": "running", "index": idx, "count": count, "mz": mz},
+                payload,
+            )
+
+        def wait(timeout):
+            # keep serving commands and status requests during the dwell time
+            self.wait_dwell(timeout, stop_event)
+
+        self.scan_running = True
+        try:
+            completed = self.qsource3.scan(
+                mz_values, dwell, on_point, stop_event, wait=wait
+            )
+            state = "finished" if completed else "aborted"
+        except QSource3NotConnectedException as e:
+            logger.error(f"Connection error during scan: {e}")
+            self.publish_error("scan", str(e))
+            state = "error"
+        finally:
+            self.scan_running = False
+            self.publish_triggers()
+        self.publish_response("scan", {"state": state, "count": count}, payload)
+
+    @command("sim", dict)
+    def handle_sim(self, payload, stop_event=None):
+        if "value" not in payload:
+            state = "running" if self.sim_running else "idle"
+            self.publish_response("sim", {"state": state}, payload)
+            return
+
+        value = payload["value"]
+        if value.get("abort"):
+            return  # the running program was already stopped by on_command
+
+        try:
+            points, cycles = self.parse_sim(value)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Invalid SIM payload {payload}: {e}")
+            self.publish_response("sim", {"state": "error", "error": str(e)}, payload)
+            return
+
+        self.run_sim(points, cycles, payload, stop_event or Event())
+
+    def parse_sim(self, value):
+        """Returns the (mz, dwell in seconds) points and the number of cycles of a SIM request."""
+        default_dwell = value.get("dwell")
+        points = []
+        for point in value["points"]:
+            if not isinstance(point, dict):
+                raise TypeError(f"SIM point must be an object, not {point!r}")
+            mz = float(point["mz"])
+            if not math.isfinite(mz):
+                raise ValueError(f"SIM m/z values must be finite: {point['mz']}")
+            dwell = float(point.get("dwell", default_dwell)) / 1000
+            # an infinite dwell would never end, a NaN dwell at once
+            if not math.isfinite(dwell) or dwell < 0:
+                raise ValueError(
+                    f"Invalid dwell time: {point.get('dwell', default_dwell)}"
+                )
+            points.append((mz, dwell))
+        if not points:
+            raise ValueError("SIM program has no points")
+        cycles = value.get("cycles", 0)
+        # true or 2.5 is not a number of cycles
+        if not isinstance(cycles, int) or isinstance(cycles, bool) or cycles < 0:
+            raise ValueError(f"Invalid number of cycles: {cycles!r}")
+        return points, cycles
+
+    def run_sim(self, points, cycles, payload, stop_event):
+        def on_cycle(cycle, timings):
+            self.publish_response(
+                "sim", {"state": "running", "cycle": cycle, "points": timings}, payload
+            )
+
+        def on_point(idx, mz, applied):
+            self.record_trigger(mz, applied)
+
+        def wait(timeout):
+            # keep serving queries and status requests during the dwell time
+            self.wait_dwell(timeout, stop_event)
+
+        self.sim_running = True
+        completed = 0
+        try:
+            completed = self.qsource3.run_sim(
+                points, cycles, on_cycle, stop_event, wait=wait, on_point=on_point
+            )
+            # a program with cycles 0 runs until it is stopped
+            state = "aborted" if stop_event.is_set() else "finished"
+        except QSource3NotConnectedException as e:
+            logger.error(f"Connection error during SIM program: {e}")
+            self.publish_error("sim", str(e))
+            state = "error"
+        finally:
+            self.sim_running = False
+            self.publish_triggers()
+        self.publish_response("sim", {"state": state, "cycles": completed}, payload)
+
+    def record_trigger(self, mz, applied):
+        """Records the setpoint event of an m/z applied by a scan or SIM program."""
+        if self.trigger_stream is None:
+            return
+        event = self.trigger_stream.setpoint(applied, mz, self.qsource3.get_setpoints())
+        if self.trigger.get("settle_time") is not None:
+            self.trigger_settling = event
+        self.publish_triggers_if_due()
+
+    def wait_dwell(self, timeout, stop_event):
+        """Serves jobs for `timeout` seconds, recording the settled event of the last setpoint."""
+        event, self.trigger_settling = self.trigger_settling, None
+        if event is not None:
+            end = time.monotonic() + timeout
+            settled = event[2] + self.trigger["settle_time"] / 1000
+            if settled <= end:  # a dwell shorter than the settle time has no event
+                self.worker.run_pending(
+                    max(0.0, settled - time.monotonic()), stop_event
+                )
+                if stop_event.is_set():
+                    return
+                self.trigger_stream.settled(event, settled)
+                self.publish_triggers_if_due()
+            timeout = end - time.monotonic()
+        self.worker.run_pending(max(0.0, timeout), stop_event)
+
+    def publish_triggers_if_due(self):
+        now = time.monotonic()
+        interval = self.trigger.get("publish_interval", 100) / 1000
+        full = len(self.trigger_stream) >= self.trigger.get("chunk_size", 100)
+        if full or now - self.trigger_publish_time >= interval:
+            self.trigger_publish_time = now
+            self.publish_triggers()
+
+    def publish_triggers(self):
+        """Publishes the buffered trigger events in chunks, keeps them while offline."""
+        if self.trigger_stream is None or not self.owner.is_connected():
+            return
+        stream = self.trigger_stream
+        # wall clock time minus monotonic time, converts the event times
+        offset = time.time() - time.monotonic()
+        while len(stream):
+            payload = {
+                **stream.drain(self.trigger.get("chunk_size", 100)),
+                "offset": offset,
+                "dropped": stream.dropped,
+            }
+            self.publish(
+                f"{self.topic_base}/trigger/{self.device_name}",
+                encode(payload, self.payload_encoding),
+                "trigger",
+            )
+
+    def request_status(self):
+        """Queues a status publish unless one is already waiting for the worker."""
+        if not self.status_pending:
+            self.status_pending = True
+            self.worker.submit_read(self.publish_status)
+
+    @handle_connection_error
+    def publish_status(self):
+        self.status_pending = False
+        if self.owner.is_connected():  # no serial traffic for a status nobody gets
+            status = self.qsource3.get_status()
+            status_payload = (
+                None if status is None else self.status_filter.filter(status)
+            )
+            if status_payload is None:
+                self.metrics.inc("status_suppressed")
+            else:
+                self.publish(
+                    f"{self.topic_base}/status/{self.device_name}/state",
+                    encode(status_payload, self.status_encoding),
+                    "status",
+                    latest=True,
+                )
+
+    def sample_telemetry(self):
+        """Idle job of the worker, returns the seconds until the next sample is due."""
+        now = time.monotonic()
+        if now < self.next_sample_time:
+            return self.next_sample_time - now
+        if not self.qsource3.is_connected():
+            return 1.0  # commands and status requests (re)connect the device
+        try:
+            values = self.qsource3.read_telemetry(self.telemetry_buffer.fields)
+        except QSource3NotConnectedException as e:
+            logger.error(f"Connection error while sampling telemetry: {e}")
+            return 1.0
+        self.telemetry_buffer.append(now, values)
+        self.metrics.inc("telemetry_samples")
+
+        if now - self.telemetry_publish_time >= (
+            self.telemetry.get("publish_interval", 1000) / 1000
+        ):
+            self.telemetry_publish_time = now
+            self.publish_telemetry()
+
+        self.next_sample_time = now + self.telemetry.get("sample_interval", 0) / 1000
+        return max(0.0, self.next_sample_time - time.monotonic())
+
+    def publish_telemetry(self):
+        """Publishes the buffered telemetry samples in chunks, keeps them while offline."""
+        if not self.owner.is_connected():
+            return
+        buffer = self.telemetry_buffer
+        # wall clock time of the monotonic sample timestamps
+        offset = time.time() - time.monotonic()
+        while len(buffer):
+            times, values = buffer.drain(self.telemetry.get("chunk_size", 1000))
+            payload = {
+                "t0": times[0] + offset,
+                "dt": [round((t - times[0]) * 1000, 3) for t in times],
+                **values,
+                "dropped": buffer.dropped,
+            }
+            self.publish(
+                f"{self.topic_base}/telemetry/{self.device_name}",
+                encode(payload, self.payload_encoding),
+                "telemetry",
+            )
+
+    def publish_metrics(self):
+        """Publishes the counters, timings and gauges of the device."""
+        self.publish(
+            f"{self.topic_base}/metrics/{self.device_name}",
+            encode(self.metrics.snapshot(), self.payload_encoding),
+            "metrics",
+            latest=True,
+        )
+
+    def connect_on_start(self):
+        try:
+            self.qsource3.check_connection()
+        except QSource3NotConnectedException as e:
+            logger.warning(f"Device {self.device_name} not connected on start: {e}")
+            return
+        logger.info(
+            f"Device {self.device_name} ready "
+            f"{(time.monotonic() - self.owner.started) * 1000:.0f} ms after start"
+        )
+
+    def on_qsource3_connected(self):
+        """Publishes a retained message indicating the qsource3 is connected."""
+        topic = f"{self.topic_base}/connected/{self.device_name}"
+        payload = "1"  # You can use any payload that indicates the device is connected, "1" is common
+        self.publish(topic, payload, "connected", retain=True, latest=True)
+        logger.debug(f"Published qsource3 connected status to {topic}")
+
+    def publish_response(self, command, value, sender_payload, superseded=()):
+        """Publishes the response to `sender_payload` and to each merged request in `superseded`."""
+        self.publish_encoded_response(
+            command, encode(value, self.payload_encoding), sender_payload, superseded
+        )
+
+    def publish_parameter(self, name, sender_payload, superseded=()):
+        """Publishes the value of parameter `name` from the response cache.
+
+        The cache is bypassed while the device is disconnected, so the query
+        still tries to reconnect and reports the connection error.
+        """
+        if name == "range":
+            read = self.qsource3.get_range
+        else:
+            read = partial(getattr, self.qsource3, name)
+        if self.qsource3.is_connected():
+            value = self.response_cache.get(self.qsource3.current_range, name, read)
+        else:
+            value = encode(read(), self.payload_encoding)
+        self.publish_encoded_response(name, value, sender_payload, superseded)
+
+    def publish_encoded_response(self, command, value, sender_payload, superseded=()):
+        topic = f"{self.topic_base}/response/{self.device_name}/{command}"
+        for payload in (*superseded, sender_payload):
+            self.publish(
+                topic,
+                encode_response(value, payload, self.payload_encoding),
+                "response",
+            )
+            logger.debug(f"Publish topic: {topic}, sender payload: {payload}")
+
+    def publish_error(self, command, error_message):
+        error_payload = {"error": error_message, "command": command}
+        self.publish(
+            f"{self.topic_base}/error/{self.device_name}/disconnected",
+            encode(error_payload, self.payload_encoding),
+            "error",
+        )
+        logger.debug(f"Publish error: {error_message}")
+
+    def stop(self):
+        self.scan_stop_event.set()
+        self.sim_stop_event.set()
+        self.worker.stop()
+        self.qsource3.stop()
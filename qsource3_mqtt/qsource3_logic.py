@@ -1,16 +1,37 @@
-import json
 import logging
+import math
 import time
 from ctypes import Array
 from functools import wraps
+from threading import Event
 
-from pyvisa import VisaIOError
-from qsource3.massfilter import Quadrupole
-from qsource3.qsource3driver import QSource3Driver
+from .qsource3_batch import BatchingDriver
+from .qsource3_metrics import InstrumentedDriver, QSource3Metrics
+from .qsource3_settings import QSource3SettingsStore
+from .qsource3_setpoints import QSource3SetpointTable
 
 logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG)
 
+# retry delays in seconds while the device does not respond during connect
+BACKOFF_INITIAL_DELAY = 0.005
+BACKOFF_MAX_DELAY = 0.1
+
+# settings stored per range, applied to the Quadrupole in this order
+SETTINGS_PER_RANGE = (
+    "calib_pnts_dc",
+    "calib_pnts_rf",
+    "dc_offst",
+    "is_dc_on",
+    "is_rod_polarity_positive",
+)
+
+# parameters accepted by apply_batch, applied in this order
+BATCH_PARAMETERS = ("range", *SETTINGS_PER_RANGE, "mz")
+
+# registers written by Quadrupole for an m/z, in the order of get_setpoints()
+SETPOINT_REGISTERS = ("rf_amp", "dc1", "dc2")
+
 
 class QSource3NotConnectedException(Exception):
     """Exception raised when the QSource3 peripheral is not connected."""
@@ -24,7 +45,8 @@ def check_connection_decorator(method):
         self.check_connection()
         try:
             return method(self, *args, **kwargs)
-        except (VisaIOError, ConnectionError) as e:
+        except self.device_errors as e:
+            self.metrics.inc("device_errors")
             self._is_connected = False
             self.driver = None
             self.quads = [None, None]
@@ -35,117 +57,234 @@ def check_connection_decorator(method):
     return wrapper
 
 
+def make_scan_points(start, stop, step, max_points=None):
+    """Returns the list of m/z values from `start` to `stop` (inclusive) with `step`.
+
+    Raises ValueError if the scan would have more than `max_points` points.
+    """
+    if not all(math.isfinite(value) for value in (start, stop, step)):
+        raise ValueError(f"Scan limits must be finite: {start}, {stop}, {step}")
+    if step == 0:
+        raise ValueError("Scan step must not be zero")
+    if (stop - start) * step < 0:
+        raise ValueError(f"Scan step {step} does not lead from {start} to {stop}")
+    count = int(math.floor((stop - start) / step + 1e-9)) + 1
+    if max_points is not None and count > max_points:
+        raise ValueError(f"Scan has more than {max_points} points: {count}")
+    return [start + idx * step for idx in range(count)]
+
+
 class QSource3Logic:
-    def __init__(self, comport, r0, on_connected, number_of_ranges, settings_file):
+    def __init__(
+        self,
+        comport,
+        r0,
+        on_connected,
+        number_of_ranges,
+        settings_file,
+        poll_intervals=None,
+        settings_save_delay=500,
+        connect_delay=0,
+        connect_timeout=2000,
+        driver_factory=None,
+        metrics=None,
+    ):
         self.settings_file = settings_file
+        self.metrics = metrics if metrics is not None else QSource3Metrics()
+        self.settings_store = QSource3SettingsStore(
+            settings_file, delay=settings_save_delay / 1000, metrics=self.metrics
+        )
         self.number_of_ranges = number_of_ranges
         self.on_connected = on_connected
         self.r0 = r0
         self.comport = comport
+        # called with the comport on connect, defaults to QSource3Driver
+        self.driver_factory = driver_factory
         self.driver = None
         self.quads = [None, None]
         self.current_range = 0
+        self.settings = None
+        # errors of a lost device, VisaIOError is added by the first connect
+        self.device_errors = (ConnectionError,)
+        self._last_mz = [0] * number_of_ranges
+
+        # fixed pause in seconds between connect steps, for hardware that needs it
+        self.connect_delay = connect_delay / 1000
+        # how long in seconds a connect step is retried before giving up
+        self.connect_timeout = connect_timeout / 1000
+        self.connect_metrics = {}
+
+        # refresh period in seconds of the status values that drift on the device,
+        # values without a period are read once and then updated by the setters
+        if poll_intervals is None:
+            poll_intervals = {"current": 1000}
+        self.poll_intervals = {
+            field: interval / 1000 for field, interval in poll_intervals.items()
+        }
+        # the frequency of each range is a property of the generator, read on the
+        # first connect and kept across reconnects
+        self._frequencies = [None] * number_of_ranges
+        self._cache = {}
+        self._cache_time = {}
+        # applied setpoints per m/z of each range, valid until a setting changes,
+        # kept across range switches and reconnects (the settings are restored)
+        self.setpoint_tables = [
+            QSource3SetpointTable() for _ in range(number_of_ranges)
+        ]
 
         self._is_connected = False
+        # a connect after a failed first connect is not a reconnect
+        self._connected_once = False
 
     def check_connection(self):
         if not self.is_connected():
             self.try_connect()
 
     def _delay(self):
-        time.sleep(0.1)
+        if self.connect_delay > 0:
+            time.sleep(self.connect_delay)
+
+    def _call_with_backoff(self, fn, *args):
+        """Calls `fn`, retrying with exponential backoff while the device does not respond."""
+        from pyvisa import VisaIOError
+
+        delay = BACKOFF_INITIAL_DELAY
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return fn(*args)
+            except VisaIOError:
+                if time.monotonic() + delay > deadline:
+                    raise
+                self.connect_metrics["retries"] += 1
+                time.sleep(delay)
+                delay = min(delay * 2, BACKOFF_MAX_DELAY)
+
+    def _apply_setting(self, quad, name, value):
+        """Sets `name` of `quad` to `value` unless it already has this value."""
+        current = getattr(quad, name)
+        if hasattr(current, "tolist"):
+            current = current.tolist()
+        if current == value:
+            self.connect_metrics["skipped"] += 1
+            return
+        self._delay()
+        self._call_with_backoff(setattr, quad, name, value)
+        self.connect_metrics["writes"] += 1
+        logger.debug(f"{quad.name} {name}: {value}")
+
+    def _init_settings(self):
+        self.settings = {
+            "range": 0,
+            "calib_pnts_dc": [[[0, 0]], [[0, 0]]],
+            "calib_pnts_rf": [[[0, 0]], [[0, 0]]],
+            "dc_offst": [0, 0],
+            "is_dc_on": [True, True],
+            "is_rod_polarity_positive": [True, True],
+        }
+
+        settings = self.load_settings()
+        if settings is None:
+            return
+
+        for idx in range(self.number_of_ranges):
+            self.settings["calib_pnts_dc"][idx] = self.check_calibration_points(
+                settings["calib_pnts_dc"][idx]
+            )
+            self.settings["calib_pnts_rf"][idx] = self.check_calibration_points(
+                settings["calib_pnts_rf"][idx]
+            )
+            self.settings["dc_offst"][idx] = self.check_number(
+                settings["dc_offst"][idx]
+            )
+            self.settings["is_dc_on"][idx] = self.check_boolean(
+                settings["is_dc_on"][idx]
+            )
+            self.settings["is_rod_polarity_positive"][idx] = self.check_boolean(
+                settings["is_rod_polarity_positive"][idx]
+            )
+        self.settings["range"] = self.check_mass_range(settings["range"])
 
     def try_connect(self):
-        try:
-            self.driver = QSource3Driver(self.comport)
-            for idx in range(self.number_of_ranges):
-                self._delay()
-                self.driver.set_range(idx)
-                self._delay()
-                freq = self.driver.frequency
-                self.quads[idx] = Quadrupole(
-                    frequency=freq,
-                    r0=self.r0,
-                    driver=self.driver,
-                    name=f"Q{idx}",
-                )
-                self.quads[idx].mz = 0
-            self._delay()
+        # the settings file is read on the first connect only, a reconnect
+        # restores the settings and m/z values kept in memory
+        reconnect = self._connected_once
+        self.connect_metrics = {
+            "reconnect": reconnect,
+            "duration": None,
+            "writes": 0,
+            "skipped": 0,
+            "retries": 0,
+        }
+        start = time.monotonic()
+        # pyvisa and the qsource3 library (and NumPy through both) are imported
+        # on the first connect, which runs on the worker thread, not on the
+        # startup path
+        from pyvisa import VisaIOError
 
-            self.settings = {
-                "range": 0,
-                "calib_pnts_dc": [[[0, 0]], [[0, 0]]],
-                "calib_pnts_rf": [[[0, 0]], [[0, 0]]],
-                "dc_offst": [0, 0],
-                "is_dc_on": [True, True],
-                "is_rod_polarity_positive": [True, True],
-            }
+        self.device_errors = (VisaIOError, ConnectionError)
+        try:
+            if self.settings is None:
+                self._init_settings()
 
-            settings = self.load_settings()
-            if settings is None:
-                self.driver.set_range(self.current_range)
+            from qsource3.massfilter import Quadrupole
 
-            else:
-                for idx in range(self.number_of_ranges):
-                    self.quads[idx].calib_pnts_dc = self.check_calibration_points(
-                        settings["calib_pnts_dc"][idx]
-                    )
-                    self.settings["calib_pnts_dc"][idx] = self.quads[
-                        idx
-                    ].calib_pnts_dc.tolist()
-                    logger.debug(
-                        f"Calibration points DC: {self.quads[idx].calib_pnts_dc}"
-                    )
-                    self._delay()
+            if self.driver_factory is None:
+                from qsource3.qsource3driver import QSource3Driver
 
-                    self.quads[idx].calib_pnts_rf = self.check_calibration_points(
-                        settings["calib_pnts_rf"][idx]
-                    )
-                    self.settings["calib_pnts_rf"][idx] = self.quads[
-                        idx
-                    ].calib_pnts_rf.tolist()
-                    logger.debug(
-                        f"Calibration points RF: {self.quads[idx].calib_pnts_rf}"
-                    )
-                    self._delay()
+                self.driver_factory = QSource3Driver
 
-                    self.quads[idx].dc_offst = self.check_number(
-                        settings["dc_offst"][idx]
-                    )
-                    self.settings["dc_offst"][idx] = self.quads[idx].dc_offst
-                    logger.debug(f"DC offset: {self.quads[idx].dc_offst}")
+            self.driver = BatchingDriver(
+                InstrumentedDriver(self.driver_factory(self.comport), self.metrics)
+            )
+            self._cache.clear()
+            for idx in range(self.number_of_ranges):
+                self._delay()
+                self._call_with_backoff(self.driver.set_range, idx)
+                if self._frequencies[idx] is None:
                     self._delay()
-
-                    self.quads[idx].is_dc_on = self.check_boolean(
-                        settings["is_dc_on"][idx]
+                    self._frequencies[idx] = self._call_with_backoff(
+                        lambda: self.driver.frequency
                     )
-                    self.settings["is_dc_on"][idx] = self.quads[idx].is_dc_on
-                    logger.debug(f"Is DC on: {self.quads[idx].is_dc_on}")
-                    self._delay()
+                quad = Quadrupole(
+                    frequency=self._frequencies[idx],
+                    r0=self.r0,
+                    driver=self.driver,
+                    name=f"Q{idx}",
+                )
+                self.quads[idx] = quad
 
-                    self.quads[idx].is_rod_polarity_positive = self.check_boolean(
-                        settings["is_rod_polarity_positive"][idx]
-                    )
-                    self.settings["is_rod_polarity_positive"][idx] = self.quads[
-                        idx
-                    ].is_rod_polarity_positive
-                    logger.debug(
-                        f"Is rod polarity positive: {self.quads[idx].is_rod_polarity_positive}"
-                    )
-                    self._delay()
+                for name in SETTINGS_PER_RANGE:
+                    self._apply_setting(quad, name, self.settings[name][idx])
 
-                self.current_range = self.check_mass_range(settings["range"])
-                self.driver.set_range(self.current_range)
-                self.settings["range"] = self.current_range
-                logger.debug(f"Current range: {self.current_range}")
                 self._delay()
+                self._call_with_backoff(self._apply_mz, idx, self._last_mz[idx])
+                self.connect_metrics["writes"] += 1
+
+            self.current_range = self.settings["range"]
+            self._delay()
+            self._call_with_backoff(self.driver.set_range, self.current_range)
+            logger.debug(f"Current range: {self.current_range}")
+
+            self.connect_metrics["duration"] = time.monotonic() - start
+            self.metrics.observe("try_connect", self.connect_metrics["duration"])
+            self.metrics.inc("reconnects" if reconnect else "connects")
+            logger.info(
+                f"QSource3 at {self.comport} {'reconnected' if reconnect else 'connected'} in "
+                f"{self.connect_metrics['duration']:.3f} s "
+                f"(writes: {self.connect_metrics['writes']}, "
+                f"skipped: {self.connect_metrics['skipped']}, "
+                f"retries: {self.connect_metrics['retries']})"
+            )
 
             self._is_connected = True
+            self._connected_once = True
             if self.on_connected is not None:
                 self.on_connected()
 
         except VisaIOError:
             self._is_connected = False
+            self.metrics.inc("connect_failures")
             raise QSource3NotConnectedException("QSource3 peripheral is not connected.")
 
     def is_connected(self):
@@ -159,9 +298,7 @@ class QSource3Logic:
     @is_dc_on.setter
     @check_connection_decorator
     def is_dc_on(self, value):
-        self.quads[self.current_range].is_dc_on = value
-        self.settings["is_dc_on"][self.current_range] = value
-        self.save_settings()
+        self._change_setting("is_dc_on", value)
 
     @property
     @check_connection_decorator
@@ -171,9 +308,7 @@ class QSource3Logic:
     @is_rod_polarity_positive.setter
     @check_connection_decorator
     def is_rod_polarity_positive(self, value):
-        self.quads[self.current_range].is_rod_polarity_positive = value
-        self.settings["is_rod_polarity_positive"][self.current_range] = value
-        self.save_settings()
+        self._change_setting("is_rod_polarity_positive", value)
 
     @property
     @check_connection_decorator
@@ -189,10 +324,7 @@ class QSource3Logic:
     @check_connection_decorator
     def calib_pnts_dc(self, value: Array):
         logger.debug(f"Setting calib_pnts_dc: {value}")
-        self.quads[self.current_range].calib_pnts_dc = value
-        self.mz = self.quads[self.current_range].mz  # set mz to the last value
-        self.settings["calib_pnts_dc"][self.current_range] = value
-        self.save_settings()
+        self._change_setting("calib_pnts_dc", value)
 
     @property
     @check_connection_decorator
@@ -203,10 +335,7 @@ class QSource3Logic:
     @check_connection_decorator
     def calib_pnts_rf(self, value: Array):
         logger.debug(f"Setting calib_pnts_rf: {value}")
-        self.quads[self.current_range].calib_pnts_rf = value
-        self.mz = self.quads[self.current_range].mz  # set mz to the last value
-        self.settings["calib_pnts_rf"][self.current_range] = value
-        self.save_settings()
+        self._change_setting("calib_pnts_rf", value)
 
     @property
     @check_connection_decorator
@@ -216,8 +345,19 @@ class QSource3Logic:
     @dc_offst.setter
     @check_connection_decorator
     def dc_offst(self, value: float):
-        self.quads[self.current_range].dc_offst = value
-        self.settings["dc_offst"][self.current_range] = value
+        self._change_setting("dc_offst", value)
+
+    def _change_setting(self, name, value):
+        """Sets `name` of the current range and applies its last m/z again."""
+        # stored first, the setpoint table already follows the new value
+        self.settings[name][self.current_range] = value
+        with self.driver.batch():
+            setattr(self.quads[self.current_range], name, value)
+            self._settings_changed()
+            # the Quadrupole may write the setpoints of the m/z it computed
+            # last, which is not the applied one after a table hit or a scan
+            self._apply_mz(self.current_range, self._last_mz[self.current_range])
+        self._invalidate_setpoints()
         self.save_settings()
 
     @check_connection_decorator
@@ -226,15 +366,25 @@ class QSource3Logic:
             logger.error(f"Invalid range value: {value}")
             return
 
-        if self.driver is not None:
-            self.driver.set_range(value)
-            self.current_range = value
+        if value == self.current_range:
+            # the device already is on this range with its m/z applied
+            self.metrics.inc("range_switches_skipped")
+            return
 
-            self.mz = self.quads[self.current_range].mz  # set mz to the last value
+        if self.driver is not None:
+            with self.metrics.timed("range_switch"), self.driver.batch():
+                self._switch_range(value)
+                self.mz = self._last_mz[value]  # set mz to the last value
 
             self.settings["range"] = value
             self.save_settings()
 
+    def _switch_range(self, value):
+        self.driver.set_range(value)
+        self.current_range = value
+        # the status values of the new range come from its setpoint table
+        self._invalidate_setpoints()
+
     @check_connection_decorator
     def get_range(self) -> int:
         return self.current_range
@@ -242,46 +392,305 @@ class QSource3Logic:
     @property
     @check_connection_decorator
     def mz(self) -> float:
-        return self.quads[self.current_range].mz
+        return self._last_mz[self.current_range]
 
     @mz.setter
     @check_connection_decorator
     def mz(self, value: float):
-        self.quads[self.current_range].mz = value
-        # mz element is not in settings => not saved
+        # the RF amplitude and DC voltages of the m/z are sent back-to-back
+        with self.driver.batch():
+            self._apply_mz(self.current_range, value)
+        self._last_mz[self.current_range] = value
+        self._invalidate_setpoints()
+        # mz element is not in settings => not saved, only restored on reconnect
+
+    def _apply_mz(self, idx, value):
+        """Writes the setpoints of m/z `value` of range `idx`, replaying them from its table if known."""
+        writes = self.setpoint_tables[idx].get(value)
+        if writes is None:
+            writes = self._compute_mz(idx, value)
+        self.driver.write(writes)
+
+    def _compute_mz(self, idx, value):
+        """Returns the register writes Quadrupole makes for m/z `value` of range `idx`, stored in its table."""
+        with self.driver.capture() as writes:
+            self.quads[idx].mz = value
+        # the setpoints are the written values, read back only if a register is missing
+        registers = {
+            name[4:] if name.startswith("set_") else name: args[0]
+            for name, args in writes
+            if len(args) == 1
+        }
+        setpoints = None
+        if all(name in registers for name in SETPOINT_REGISTERS):
+            setpoints = tuple(registers[name] for name in SETPOINT_REGISTERS)
+        writes = tuple(writes)
+        self.setpoint_tables[idx].put(value, writes, setpoints)
+        return writes
+
+    @check_connection_decorator
+    def prepare_setpoints(self, mz_values):
+        """Computes the register writes of the m/z values of a scan missing from the table."""
+        table = self.setpoint_tables[self.current_range]
+        # a scan longer than the table would evict its own first points
+        for value in mz_values[: table.max_size]:
+            if table.get(value) is None:
+                self._compute_mz(self.current_range, value)
+
+    def scan(self, mz_values, dwell, on_point=None, stop_event=None, wait=None):
+        """Sweeps the current range through `mz_values`, holding each point for `dwell` seconds.
+
+        `on_point(index, mz, applied)` is called after each point is applied at
+        the monotonic time `applied`. The scan
+        stops early when `stop_event` is set. `wait(timeout)` is used to spend
+        the dwell time (defaults to `stop_event.wait`). Returns True if all
+        points were applied, False if the scan was aborted.
+        """
+        if stop_event is None:
+            stop_event = Event()
+        if wait is None:
+            wait = stop_event.wait
+        for idx, value in enumerate(mz_values):
+            if stop_event.is_set():
+                return False
+            self.mz = value
+            applied = time.monotonic()
+            if on_point is not None:
+                on_point(idx, value, applied)
+            if idx + 1 < len(mz_values):
+                # computed one point ahead in the dwell, not all before the
+                # first point, which would hold back the queued commands
+                self.prepare_setpoints(mz_values[idx + 1 : idx + 2])
+            wait(max(0.0, applied + dwell - time.monotonic()))
+        return not stop_event.is_set()
+
+    def run_sim(
+        self, points, cycles, on_cycle=None, stop_event=None, wait=None, on_point=None
+    ):
+        """Runs a selected-ion monitoring program on the current range.
+
+        Cycles `cycles` times (0 = until stopped) through the (mz, dwell)
+        `points`. Each dwell in seconds is timed on the monotonic clock from
+        the moment its m/z is applied, so it does not depend on how long the
+        previous point took. `on_cycle(cycle, timings)` receives the achieved
+        timing of each point of a completed cycle. `stop_event`, `wait` and
+        `on_point` work as in `scan`. Returns the number of completed cycles, the program
+        was aborted if it is less than `cycles`.
+        """
+        if stop_event is None:
+            stop_event = Event()
+        if wait is None:
+            wait = stop_event.wait
+        cycle = 0
+        while cycles == 0 or cycle < cycles:
+            timings = []
+            for idx, (mz, dwell) in enumerate(points):
+                if stop_event.is_set():
+                    return cycle
+                begin = time.monotonic()
+                self.mz = mz
+                applied = time.monotonic()
+                if on_point is not None:
+                    on_point(idx, mz, applied)
+                # computed one point ahead in the dwell, as in `scan`
+                self.prepare_setpoints([points[(idx + 1) % len(points)][0]])
+                wait(max(0.0, applied + dwell - time.monotonic()))
+                timings.append(
+                    {
+                        "mz": mz,
+                        "apply_ms": round((applied - begin) * 1000, 3),
+                        "dwell_ms": round((time.monotonic() - applied) * 1000, 3),
+                    }
+                )
+            if stop_event.is_set():
+                return cycle  # the last cycle was cut short
+            cycle += 1
+            if on_cycle is not None:
+                on_cycle(cycle, timings)
+        return cycle
+
+    @check_connection_decorator
+    def apply_batch(self, params):
+        """Applies several parameters in one transaction.
+
+        The range is switched first, the settings of the (new) range follow and
+        the m/z is applied once at the end. The settings are saved once.
+        Returns the names of the applied parameters.
+        """
+        self.check_batch(params)
+        new_range = params.get("range", self.current_range)
+
+        switch = new_range != self.current_range
+        start = time.perf_counter()
+        # the range, the settings and the m/z are sent back-to-back
+        try:
+            with self.driver.batch():
+                if switch:
+                    self._switch_range(new_range)
+
+                quad = self.quads[self.current_range]
+                for name in SETTINGS_PER_RANGE:
+                    if name in params:
+                        setattr(quad, name, params[name])
+                        self._settings_changed()
+
+                mz = params.get("mz", self._last_mz[self.current_range])
+                self._apply_mz(self.current_range, mz)
+        except Exception:
+            # the table may hold setpoints of settings the reconnect reverts
+            self.setpoint_tables[new_range].clear()
+            # the queued writes (the range switch too) are sent despite the
+            # error, whatever it is the next command reconnects, which restores
+            # the range and the settings kept in memory on the device
+            self.current_range = self.settings["range"]
+            self._is_connected = False
+            self.driver = None
+            self.quads = [None, None]
+            raise
+        if switch:
+            self.metrics.observe("range_switch", time.perf_counter() - start)
+        self._invalidate_setpoints()
+
+        # kept in memory only once the device took the batch, a failed batch
+        # is undone by the reconnect
+        self.settings["range"] = new_range
+        for name in SETTINGS_PER_RANGE:
+            if name in params:
+                self.settings[name][new_range] = params[name]
+        self._last_mz[new_range] = mz
+
+        self.save_settings()
+        return [name for name in BATCH_PARAMETERS if name in params]
+
+    @check_connection_decorator
+    def get_parameters(self, names=BATCH_PARAMETERS):
+        """Returns the current values of the batch parameters `names`."""
+        quad = self.quads[self.current_range]
+        values = {}
+        for name in names:
+            if name == "range":
+                values[name] = self.current_range
+            elif name == "mz":
+                values[name] = self._last_mz[self.current_range]
+            else:
+                value = getattr(quad, name)
+                values[name] = value.tolist() if hasattr(value, "tolist") else value
+        return values
 
     @check_connection_decorator
     def get_status(self):
         if self.driver is None:
             return None
+        with self.metrics.timed("get_status"):
+            return self._get_status()
+
+    def _get_status(self):
+        quad = self.quads[self.current_range]
         return {
             "range": self.current_range,
-            "frequency": self.driver.frequency,
-            "rf_amp": self.quads[self.current_range].rf,
-            "dc1": self.quads[self.current_range].dc1,
-            "dc2": self.quads[self.current_range].dc2,
-            "current": self.driver.current,
-            "mz": self.quads[self.current_range].mz,
-            "is_dc_on": self.quads[self.current_range].is_dc_on,
-            "is_rod_polarity_positive": self.quads[
-                self.current_range
-            ].is_rod_polarity_positive,
-            "max_mz": self.quads[self.current_range].max_mz,
+            "frequency": self._frequencies[self.current_range],
+            "rf_amp": self._setpoint_status(0, "rf_amp"),
+            "dc1": self._setpoint_status(1, "dc1"),
+            "dc2": self._setpoint_status(2, "dc2"),
+            "current": self._cached("current", lambda: self._read("current")),
+            "mz": self._last_mz[self.current_range],
+            "is_dc_on": quad.is_dc_on,
+            "is_rod_polarity_positive": quad.is_rod_polarity_positive,
+            "max_mz": quad.max_mz,
         }
 
+    def _setpoint_status(self, idx, field):
+        """Returns setpoint `idx` for the status, from the setpoint table unless it is polled."""
+        if field in self.poll_intervals:
+            # a polled setpoint follows the drift of the device, not the table
+            return self._cached(field, lambda: self._read(field))
+        return self._cached(field, lambda: self._setpoints()[idx])
+
+    def _read(self, field):
+        """Reads `field` (current, rf_amp, dc1, dc2) from the device."""
+        if field == "current":
+            return self.driver.current
+        quad = self.quads[self.current_range]
+        return getattr(quad, "rf" if field == "rf_amp" else field)
+
+    def _cached(self, field, read):
+        """Returns the cached `field`, reading it from the device when missing or expired."""
+        now = time.monotonic()
+        interval = self.poll_intervals.get(field)
+        if field not in self._cache or (
+            interval is not None and now - self._cache_time[field] >= interval
+        ):
+            self._cache[field] = read()
+            self._cache_time[field] = now
+        return self._cache[field]
+
+    def _invalidate_setpoints(self):
+        # the RF amplitude and DC voltages are looked up again on the next status
+        for field in ("rf_amp", "dc1", "dc2"):
+            self._cache.pop(field, None)
+
+    def _settings_changed(self):
+        # the setpoints of the current range depend on its settings
+        self.setpoint_tables[self.current_range].clear()
+        self._invalidate_setpoints()
+
+    @check_connection_decorator
+    def read_telemetry(self, fields):
+        """Reads `fields` (current, rf_amp, dc1, dc2) from the device, bypassing the status cache."""
+        return [self._read(field) for field in fields]
+
+    @check_connection_decorator
+    def get_setpoints(self):
+        return self._setpoints()
+
+    def _setpoints(self):
+        """Returns (rf_amp, dc1, dc2) of the current m/z, read back from the device if not in the table."""
+        quad = self.quads[self.current_range]
+        mz = self._last_mz[self.current_range]
+        table = self.setpoint_tables[self.current_range]
+        setpoints = table.get_setpoints(mz)
+        if setpoints is None:
+            setpoints = (quad.rf, quad.dc1, quad.dc2)
+            table.put_setpoints(mz, setpoints)
+        return setpoints
+
     def load_settings(self):
-        # return None if settings file does not exist
-        try:
-            with open(self.settings_file, "r") as f:
-                logger.info(f"Loading settings from {self.settings_file}")
-                return json.load(f)
-        except FileNotFoundError:
-            logger.info(f"Settings file {self.settings_file} not found")
-            return None
+        return self.settings_store.load()
 
     def save_settings(self):
-        with open(self.settings_file, "w") as f:
-            json.dump(self.settings, f, indent=4)
+        # written in the background after the debounce delay
+        self.settings_store.save(self.settings)
+
+    def stop(self):
+        self.settings_store.close()
+
+    def check_batch(self, params):
+        """Raises TypeError or ValueError unless every parameter of a batch is valid."""
+        if not isinstance(params, dict):
+            raise TypeError(f"Batch parameters must be a dictionary, not {params}")
+        unknown = set(params) - set(BATCH_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unknown batch parameters: {sorted(unknown)}")
+        checks = {
+            "calib_pnts_dc": self.check_calibration_points,
+            "calib_pnts_rf": self.check_calibration_points,
+            "dc_offst": self.check_number,
+            "is_dc_on": self.check_boolean,
+            "is_rod_polarity_positive": self.check_boolean,
+            "mz": self.check_number,
+        }
+        for name, value in params.items():
+            if name == "range":
+                valid = (
+                    isinstance(value, int)
+                    and not isinstance(value, bool)
+                    and 0 <= value < self.number_of_ranges
+                )
+            else:
+                # the check helpers replace an invalid value by a default
+                valid = checks[name](value) is value
+            if not valid:
+                raise ValueError(f"Invalid value for {name}: {value!r}")
 
     def check_mass_range(self, value):
         if value < 0 or value >= self.number_of_ranges:
@@ -304,7 +713,9 @@ class QSource3Logic:
         return value
 
     def check_number(self, value):
-        if not isinstance(value, (int, float)):
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return 0
+        if not math.isfinite(value):  # NaN or Infinity is no setpoint
             return 0
         return value
 
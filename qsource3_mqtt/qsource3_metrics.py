@@ -0,0 +1,232 @@
+import logging
+import time
+from contextlib import contextmanager
+from functools import partial
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the timing histogram buckets
+TIMING_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+
+class Histogram:
+    def __init__(self, buckets=TIMING_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                return
+        self.counts[-1] += 1
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum / self.count * 1000, 3) if self.count else None,
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class QSource3Metrics:
+    """Counters, timing histograms and gauges of one QSource3 device.
+
+    Counters and timings are updated from the worker and network threads,
+    gauges are callables evaluated when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.timings.get(name)
+            if histogram is None:
+                histogram = self.timings[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                "counters": dict(self.counters),
+                "timings": {
+                    name: histogram.summary()
+                    for name, histogram in self.timings.items()
+                },
+            }
+        snapshot["gauges"] = {name: read() for name, read in self.gauges.items()}
+        return snapshot
+
+    def to_prometheus(self, labels):
+        """Returns the metrics in the Prometheus text exposition format."""
+        return to_prometheus([(labels, self)])
+
+    def families(self, labels):
+        """Returns {metric family: (type, sample lines)} labelled with `labels`."""
+        label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+        families = {}
+        with self._lock:
+            for name, value in self.counters.items():
+                metric = f"qsource3_{name}_total"
+                families[metric] = ("counter", [f"{metric}{{{label_text}}} {value}"])
+            for name, histogram in self.timings.items():
+                metric = f"qsource3_{name}_seconds"
+                lines = []
+                cumulative = 0
+                for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f'{metric}_bucket{{{label_text},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f"{metric}_sum{{{label_text}}} {histogram.sum}")
+                lines.append(f"{metric}_count{{{label_text}}} {histogram.count}")
+                families[metric] = ("histogram", lines)
+        for name, read in self.gauges.items():
+            value = read()
+            if isinstance(value, (int, float)):
+                metric = f"qsource3_{name}"
+                families[metric] = (
+                    "gauge",
+                    [f"{metric}{{{label_text}}} {float(value)}"],
+                )
+        return families
+
+
+def to_prometheus(labelled_metrics):
+    """Returns (labels, QSource3Metrics) pairs in the Prometheus text format.
+
+    The samples of a metric family follow its single `# TYPE` line, whichever
+    device they belong to.
+    """
+    families = {}
+    for labels, metrics in labelled_metrics:
+        for metric, (kind, lines) in metrics.families(labels).items():
+            families.setdefault(metric, (kind, []))[1].extend(lines)
+    text = []
+    for metric, (kind, lines) in families.items():
+        text.append(f"# TYPE {metric} {kind}")
+        text.extend(lines)
+    return "\n".join(text) + "\n"
+
+
+class InstrumentedDriver:
+    """Wraps a QSource3 driver and counts its serial transactions and errors.
+
+    Every method call, property read and attribute write on the driver is
+    one transaction with the generator.
+    """
+
+    def __init__(self, driver, metrics):
+        object.__setattr__(self, "_driver", driver)
+        object.__setattr__(self, "_metrics", metrics)
+
+    def __getattr__(self, name):
+        metrics = self._metrics
+        try:
+            value = getattr(self._driver, name)
+        except AttributeError:
+            raise
+        except Exception:
+            metrics.inc("serial_transactions")
+            metrics.inc("serial_errors")
+            raise
+        if not callable(value):
+            metrics.inc("serial_transactions")
+            return value
+        if name == "write_registers":
+            return partial(self._write_registers, value)
+
+        def call(*args, **kwargs):
+            metrics.inc("serial_transactions")
+            try:
+                return value(*args, **kwargs)
+            except Exception:
+                metrics.inc("serial_errors")
+                raise
+
+        return call
+
+    def _write_registers(self, write_registers, writes):
+        # pipelined writes, each register is one transaction
+        self._metrics.inc("serial_transactions", len(writes))
+        try:
+            errors = write_registers(writes)
+        except Exception:
+            self._metrics.inc("serial_errors", len(writes))
+            raise
+        if errors:
+            self._metrics.inc("serial_errors", len(errors))
+        return errors
+
+    def __setattr__(self, name, value):
+        self._metrics.inc("serial_transactions")
+        try:
+            setattr(self._driver, name, value)
+        except Exception:
+            self._metrics.inc("serial_errors")
+            raise
+
+
+def start_prometheus_server(port, collect):
+    """Serves `collect()` as Prometheus text on http://<host>:`port`/metrics."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = collect().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    Thread(target=server.serve_forever, name="qsource3-metrics", daemon=True).start()
+    logger.info(f"Serving Prometheus metrics on port {port}")
+    return server
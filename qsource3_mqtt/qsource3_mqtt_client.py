@@ -1,35 +1,32 @@
-import json
 import logging
+import os
+import random
 import socket
-from functools import wraps
 from select import select
-from threading import Event, Thread
-from time import time
+from threading import Event
+from time import monotonic, time
 
 import paho.mqtt.client as mqtt
 import yaml
 
-from .qsource3_logic import QSource3Logic, QSource3NotConnectedException
+from .qsource3_codec import decode
+from .qsource3_device import QSource3Device
+from .qsource3_metrics import start_prometheus_server, to_prometheus
+from .qsource3_outbox import QSource3Outbox
 
 logger = logging.getLogger(__name__)
 
-
-def handle_connection_error(method):
-    @wraps(method)
-    def wrapper(self, *args, **kwargs):
-        logger.debug(
-            f"Calling method: {method.__name__} with args: {args} and kwargs: {kwargs}"
-        )
-        try:
-            result = method(self, *args, **kwargs)
-            logger.debug(f"Method {method.__name__} returned: {result}")
-            return result
-        except QSource3NotConnectedException as e:
-            command = method.__name__.split("_")[1]  # Extract command from method name
-            logger.error(f"Connection error in method {method.__name__}: {e}")
-            self.publish_error(command, str(e))
-
-    return wrapper
+# QoS of each class of messages, overridden by the mqtt_qos option
+DEFAULT_QOS = {
+    "command": 0,  # subscription of the command topics
+    "response": 1,
+    "error": 1,
+    "connected": 1,
+    "status": 0,
+    "telemetry": 0,
+    "trigger": 1,
+    "metrics": 0,
+}
 
 
 class QSource3MQTTClientNotConnectedException(Exception):
@@ -44,41 +41,99 @@ class QSource3MQTTClientNotConnectedException(Exception):
 
 
 class QSource3MQTTClient:
-    def __init__(self, config_file):
+    def __init__(self, config_file, started=None):
+        # monotonic time the process started, before the imports of the entry point
+        init_time = monotonic()
+        self.started = init_time if started is None else started
+        self.startup_times = {"imports": init_time - self.started}
         self.user_stop_event = Event()
+        self.client = None
+        self.loop = None  # event loop of the asyncio runtime
+        self.broker_connects = 0
+        self.metrics_server = None
 
         self.load_config(config_file)
-
-        self.qsource3 = QSource3Logic(
-            comport=self.config["qsource3_com_port"],
-            r0=float(self.config["r0"]),
-            on_connected=self.on_qsource3_connected,
-            number_of_ranges=self.config["number_of_ranges"],
-            settings_file=self.config["settings_file"],
+        self.startup_times["config"] = monotonic() - init_time
+        # messages published while the broker is unreachable, replayed on reconnect
+        self.outbox = QSource3Outbox(self.config.get("outbox_size", 1000))
+
+        self.devices = {}
+        for device_config in self.device_configs():
+            device = QSource3Device(self, device_config)
+            device.metrics.gauge("broker_connects", lambda: self.broker_connects)
+            device.metrics.gauge("outbox_messages", self.outbox.__len__)
+            device.metrics.gauge("outbox_dropped", lambda: self.outbox.dropped)
+            self.devices[device.device_name] = device
+        self.startup_times["devices"] = (
+            monotonic() - init_time - self.startup_times["config"]
         )
 
+        metrics_http_port = self.config.get("metrics_http_port")
+        if metrics_http_port:
+            self.metrics_server = start_prometheus_server(
+                metrics_http_port, self.collect_metrics
+            )
+
     def load_config(self, config_file):
         with open(config_file, "r") as file:
             self.config = yaml.safe_load(file)
         self.topic_base = self.config["topic_base"]
-        self.device_name = self.config["device_name"]
         self.status_interval = self.config["status_interval"]
+        self.runtime = self.config.get("runtime", "select")
+        # period in ms of the metrics messages, 0 disables them
+        self.metrics_interval = self.config.get("metrics_interval", 10000)
+        # bounds in ms of the exponential backoff between broker reconnects
+        self.reconnect_delay_min = self.config.get("reconnect_delay_min", 50)
+        self.reconnect_delay_max = self.config.get("reconnect_delay_max", 30000)
+        self.qos = {**DEFAULT_QOS, **(self.config.get("mqtt_qos") or {})}
+
+    def device_configs(self):
+        """Returns the configuration of each served device.
+
+        Entries of the optional `devices` list override the top-level options,
+        without the list a single device is configured by the top-level options.
+        Of several devices, one without its own `settings_file` stores its
+        settings next to the top-level file, suffixed with its device name.
+        Raises ValueError if two devices share a name or a settings file.
+        """
+        defaults = {
+            key: value for key, value in self.config.items() if key != "devices"
+        }
+        entries = self.config.get("devices") or [{}]
+        configs = []
+        for entry in entries:
+            config = {**defaults, **entry}
+            if len(entries) > 1 and "settings_file" not in entry:
+                root, ext = os.path.splitext(config["settings_file"])
+                config["settings_file"] = f"{root}_{config['device_name']}{ext}"
+            configs.append(config)
+        for key in ("device_name", "settings_file"):
+            values = [config[key] for config in configs]
+            if len(set(values)) < len(values):
+                raise ValueError(f"The devices must not share a {key}: {values}")
+        return configs
 
     def connect_to_broker(self):
         logger.debug(
             f'Connecting client_id {self.config["client_id"]} to brooker {self.config["mqtt_broker"]}:{self.config["mqtt_port"]}...'
         )
         try:
-            self.client.connect(
-                self.config["mqtt_broker"],
-                self.config["mqtt_port"],
-                self.config["mqtt_connection_timeout"],
-            )
-            self.client.socket().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048)
-        except:
+            # the address is stored by create_client, reconnect reuses the client
+            self.client.reconnect()
+            self.configure_socket(self.client.socket())
+        except Exception:
             # raise QSource3MQTTClientNotConnectedException()
             self.disconnected = True, -1
 
+    def configure_socket(self, sock):
+        # 0 keeps the buffer size chosen (and auto-tuned) by the OS
+        sndbuf = self.config.get("mqtt_socket_sndbuf", 0)
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        rcvbuf = self.config.get("mqtt_socket_rcvbuf", 0)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
     def on_connect(self, client, userdata, flags, reason_code):
         logger.debug(f"on_connect with reason code {reason_code}")
         if reason_code != 0:
@@ -87,123 +142,103 @@ class QSource3MQTTClient:
                 f"reason_code = {reason_code}"
             )
 
-        # Subscribe to command topics
-        self.client.subscribe(f"{self.topic_base}/cmnd/{self.device_name}/#")
+        self.broker_connects += 1
+        if self.broker_connects == 1:
+            durations = ", ".join(
+                f"{name} {duration * 1000:.0f} ms"
+                for name, duration in self.startup_times.items()
+            )
+            logger.info(
+                f"Connected to the broker {(monotonic() - self.started) * 1000:.0f} ms "
+                f"after start ({durations})"
+            )
+
+        # also on a resumed session, which may predate a change of the devices
+        # or of the command QoS (the client id is fixed)
+        for device_name in self.devices:
+            self.client.subscribe(
+                f"{self.topic_base}/cmnd/{device_name}/#", qos=self.qos["command"]
+            )
+
+        self.flush_outbox()
+        for device in self.devices.values():
+            device.status_filter.reset()  # subscribers may have missed the last status
+            device.request_status()
+            if device.trigger_stream is not None:
+                # the events of a run that ended while the broker was unreachable
+                device.worker.submit_read(device.publish_triggers)
 
     def on_disconnect(self, client, userdata, flags, reason_code=None):
         logger.debug(f"on_disconnect with reason code {reason_code}")
         self.disconnected = True, reason_code
+        self.wake_up()
 
     def on_message(self, client, userdata, msg):
         topic = msg.topic
-        payload = json.loads(msg.payload)
-
-        if topic.endswith("/is_dc_on"):
-            self.handle_is_dc_on(payload)
-        elif topic.endswith("/is_rod_polarity_positive"):
-            self.handle_is_rod_polarity_positive(payload)
-        elif topic.endswith("/max_mz"):
-            self.handle_max_mz(payload)
-        elif topic.endswith("/calib_pnts_dc"):
-            self.handle_calib_pnts_dc(payload)
-        elif topic.endswith("/calib_pnts_rf"):
-            self.handle_calib_pnts_rf(payload)
-        elif topic.endswith("/dc_offst"):
-            self.handle_dc_offst(payload)
-        elif topic.endswith("/range"):
-            self.handle_range(payload)
-        elif topic.endswith("/mz"):
-            self.handle_mz(payload)
-
-    # Define handlers for each command topic
-    @handle_connection_error
-    def handle_is_dc_on(self, payload):
-        if "value" in payload:
-            self.qsource3.is_dc_on = payload["value"]
-        self.publish_response("is_dc_on", self.qsource3.is_dc_on, payload)
-
-    @handle_connection_error
-    def handle_is_rod_polarity_positive(self, payload):
-        if "value" in payload:
-            self.qsource3.is_rod_polarity_positive = payload["value"]
-        self.publish_response(
-            "is_rod_polarity_positive", self.qsource3.is_rod_polarity_positive, payload
+        payload = decode(msg.payload)  # JSON, MessagePack or CBOR
+
+        # <topic_base>/cmnd/<device_name>/<command>
+        prefix = f"{self.topic_base}/cmnd/"
+        device_name, _, command = topic[len(prefix) :].partition("/")
+        device = self.devices.get(device_name) if topic.startswith(prefix) else None
+        if device is None:
+            logger.warning(f"Message for unknown device on topic {topic}")
+            return
+        device.on_command(command, payload)
+
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected()
+
+    def publish(self, topic, payload, kind, retain=False, latest=False):
+        """Publishes a message of class `kind`, keeping it while the broker is unreachable.
+
+        paho queues messages with QoS 1 or 2 itself and sends them after the
+        reconnect, QoS 0 messages are kept in the outbox. Before the MQTT
+        client is created, messages of any QoS are kept in the outbox and
+        replayed with their QoS. Of a `latest` topic only the newest message
+        is kept in the outbox.
+        """
+        qos = self.qos[kind]
+        client = self.client
+        if client is not None and (qos > 0 or client.is_connected()):
+            info = client.publish(topic, payload, qos=qos, retain=retain)
+            if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+                logger.warning(f"MQTT message queue full, dropped message on {topic}")
+            if qos > 0 or info.rc != mqtt.MQTT_ERR_NO_CONN:
+                return
+        self.outbox.put(topic, payload, retain, latest, qos)
+        if self.is_connected():
+            self.flush_outbox()  # the connection came back meanwhile
+
+    def flush_outbox(self):
+        messages = self.outbox.drain()
+        for topic, payload, retain, qos in messages:
+            self.client.publish(topic, payload, qos=qos, retain=retain)
+        if messages:
+            logger.info(f"Replayed {len(messages)} messages from the outbox")
+
+    def collect_metrics(self):
+        """Returns the metrics of all devices in the Prometheus text format."""
+        return to_prometheus(
+            ({"device": name}, device.metrics) for name, device in self.devices.items()
         )
 
-    @handle_connection_error
-    def handle_max_mz(self, payload):
-        self.publish_response("max_mz", self.qsource3.max_mz, payload)
-
-    @handle_connection_error
-    def handle_calib_pnts_dc(self, payload):
-        if "value" in payload:
-            self.qsource3.calib_pnts_dc = payload["value"]
-        self.publish_response("calib_pnts_dc", self.qsource3.calib_pnts_dc, payload)
-
-    @handle_connection_error
-    def handle_calib_pnts_rf(self, payload):
-        if "value" in payload:
-            self.qsource3.calib_pnts_rf = payload["value"]
-        self.publish_response("calib_pnts_rf", self.qsource3.calib_pnts_rf, payload)
-
-    @handle_connection_error
-    def handle_dc_offst(self, payload):
-        if "value" in payload:
-            self.qsource3.dc_offst = payload["value"]
-        self.publish_response("dc_offst", self.qsource3.dc_offst, payload)
-
-    @handle_connection_error
-    def handle_range(self, payload):
-        if "value" in payload:
-            self.qsource3.set_range(payload["value"])
-        self.publish_response("range", self.qsource3.get_range(), payload)
-
-    @handle_connection_error
-    def handle_mz(self, payload):
-        if "value" in payload:
-            self.qsource3.mz = payload["value"]
-        self.publish_response("mz", self.qsource3.mz, payload)
-
-    @handle_connection_error
-    def publish_status(self):
-        if self.client is not None and self.client.is_connected():
-            status_payload = self.qsource3.get_status()
-            if status_payload is not None:
-                self.client.publish(
-                    f"{self.topic_base}/status/{self.device_name}/state",
-                    json.dumps(status_payload),
-                )
-
-    def on_qsource3_connected(self):
-        """Publishes a retained message indicating the qsource3 is connected."""
-        if self.client is not None:
-            topic = f"{self.topic_base}/connected/{self.device_name}"
-            payload = "1"  # You can use any payload that indicates the device is connected, "1" is common
-            self.client.publish(topic, payload, retain=True)
-            logger.debug(f"Published qsource3 connected status to {topic}")
-
-    def publish_response(self, command, value, sender_payload):
-        if self.client is not None and self.client.is_connected():
-            response_payload = {"value": value, "sender_payload": sender_payload}
-            topic = f"{self.topic_base}/response/{self.device_name}/{command}"
-            self.client.publish(
-                topic,
-                json.dumps(response_payload),
-            )
-            logger.debug(f"Publish topic: {topic}, payload: {response_payload}")
-
-    def publish_error(self, command, error_message):
-        if self.client is not None and self.client.is_connected():
-            error_payload = {"error": error_message, "command": command}
-            self.client.publish(
-                f"{self.topic_base}/error/{self.device_name}/disconnected",
-                json.dumps(error_payload),
-            )
-            logger.debug(f"Publish error: {error_message}")
-
     def stop(self):
         logger.debug("User stop")
         self.user_stop_event.set()
+        self.wake_up()
+        for device in self.devices.values():
+            device.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+
+    def wake_up(self):
+        """Wakes up the asyncio runtime to check the disconnected and stop flags."""
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.wakeup_event.set)
 
     def do_select(self):
         if self.client is None:
@@ -232,11 +267,18 @@ class QSource3MQTTClient:
         if time() - self.last_time >= self.status_interval / 1000:
             self.last_time = time()
             if self.client.is_connected():
-                self.publish_status()
-
-    def main(self):
-        self.disconnected = (False, None)
-
+                for device in self.devices.values():
+                    device.request_status()
+
+        if (
+            self.metrics_interval
+            and time() - self.last_metrics_time >= self.metrics_interval / 1000
+        ):
+            self.last_metrics_time = time()
+            for device in self.devices.values():
+                device.publish_metrics()
+
+    def create_client(self):
         self.client = mqtt.Client(
             client_id=self.config["client_id"],
             clean_session=False,
@@ -244,11 +286,114 @@ class QSource3MQTTClient:
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
+        # paho defaults to 20 messages in flight, which throttles QoS 1 streams
+        self.client.max_inflight_messages_set(
+            self.config.get("mqtt_max_inflight", 1000)
+        )
+        # 0 queues QoS 1 and 2 messages without limit while the broker is unreachable
+        self.client.max_queued_messages_set(self.config.get("mqtt_max_queued", 10000))
+        self.client.connect_async(
+            self.config["mqtt_broker"],
+            self.config["mqtt_port"],
+            self.config["mqtt_connection_timeout"],
+        )
+
+    def run(self):
+        """Runs the configured runtime until the broker disconnects or `stop` is called."""
+        if self.runtime == "asyncio":
+            # asyncio is imported by this runtime only, not on the startup path
+            import asyncio
+
+            asyncio.run(self.main_async())
+        else:
+            self.main()
+
+    def run_forever(self):
+        """Runs until `stop` is called, reconnecting to the broker with exponential backoff."""
+        delay = self.reconnect_delay_min / 1000
+        while not self.user_stop_event.is_set():
+            broker_connects = self.broker_connects
+            self.run()
+            if self.user_stop_event.is_set():
+                break
+            if self.broker_connects != broker_connects:
+                delay = self.reconnect_delay_min / 1000  # the last attempt succeeded
+            wait = random.uniform(
+                delay / 2, delay
+            )  # jitter spreads out reconnecting clients
+            logger.info(
+                f"Disconnected from the broker ({self.disconnected}), reconnecting in {wait:.3f} s"
+            )
+            self.user_stop_event.wait(wait)
+            delay = min(delay * 2, self.reconnect_delay_max / 1000)
+
+    def main(self):
+        self.disconnected = (False, None)
 
+        if self.client is None:
+            self.create_client()
         self.connect_to_broker()
 
         self.last_time = time()
+        self.last_metrics_time = time()
         while not self.disconnected[0] and not self.user_stop_event.is_set():
             self.do_select()
 
-        self.client = None
+    async def status_loop(self, device):
+        """Publishes the status of `device` on a fixed schedule of the event loop clock."""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        interval = self.status_interval / 1000
+        next_time = loop.time()
+        while True:
+            next_time += interval
+            await asyncio.sleep(max(0.0, next_time - loop.time()))
+            if self.client is not None and self.client.is_connected():
+                await asyncio.wrap_future(device.worker.call(device.publish_status))
+            if loop.time() > next_time + interval:
+                # the device was too slow, skip the missed ticks
+                next_time = loop.time()
+
+    async def metrics_loop(self):
+        """Publishes the metrics of all devices every `metrics_interval` ms."""
+        import asyncio
+
+        while True:
+            await asyncio.sleep(self.metrics_interval / 1000)
+            for device in self.devices.values():
+                device.publish_metrics()
+
+    async def main_async(self):
+        """Same as `main`, but served by an asyncio event loop instead of `select`."""
+        import asyncio
+
+        from .qsource3_asyncio import AsyncioHelper
+
+        self.disconnected = (False, None)
+        self.wakeup_event = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+
+        if self.client is None:
+            self.create_client()
+        helper = AsyncioHelper(self.loop, self.client)
+        self.connect_to_broker()
+
+        status_tasks = [
+            asyncio.create_task(self.status_loop(device))
+            for device in self.devices.values()
+        ]
+        if self.metrics_interval:
+            status_tasks.append(asyncio.create_task(self.metrics_loop()))
+        try:
+            while not self.disconnected[0] and not self.user_stop_event.is_set():
+                await self.wakeup_event.wait()
+                self.wakeup_event.clear()
+        finally:
+            for task in status_tasks:
+                task.cancel()
+            await asyncio.gather(*status_tasks, return_exceptions=True)
+            if self.user_stop_event.is_set() and self.client.is_connected():
+                self.client.disconnect()
+            helper.close()
+            self.loop = None
@@ -0,0 +1,43 @@
+from collections import deque
+from threading import Lock
+
+
+class QSource3Outbox:
+    """Bounded store of the messages published while the broker is unreachable.
+
+    The messages are replayed in order once the connection is back. Of a
+    `latest` topic (e.g. the retained connected flag or the metrics) only the
+    newest message is kept. When `max_size` messages are waiting, the oldest
+    one is dropped for each new message and counted in `dropped`.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.dropped = 0
+        self._messages = deque()
+        self._latest = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._messages) + len(self._latest)
+
+    def put(self, topic, payload, retain=False, latest=False, qos=0):
+        with self._lock:
+            if latest:
+                self._latest[topic] = (topic, payload, retain, qos)
+                return
+            if self.max_size <= 0:
+                self.dropped += 1
+                return
+            if len(self._messages) >= self.max_size:
+                self._messages.popleft()
+                self.dropped += 1
+            self._messages.append((topic, payload, retain, qos))
+
+    def drain(self):
+        """Removes and returns the waiting (topic, payload, retain, qos) messages."""
+        with self._lock:
+            messages = [*self._latest.values(), *self._messages]
+            self._latest.clear()
+            self._messages.clear()
+        return messages
@@ -0,0 +1,42 @@
+from .qsource3_codec import encode
+
+
+class QSource3ResponseCache:
+    """Encoded values of the query responses, per range and parameter.
+
+    A query answered from the cache needs no device access and encodes only
+    its sender payload. The owner invalidates the entries of a range whenever
+    a command writes to it.
+    """
+
+    def __init__(self, encoding="json", metrics=None):
+        self.encoding = encoding
+        self.metrics = metrics
+        self._values = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, range_, name, read):
+        """Returns the encoded value of `name` on `range_`, calling `read()` on a miss."""
+        key = (range_, name)
+        value = self._values.get(key)
+        if value is None:
+            value = encode(read(), self.encoding)
+            self._values[key] = value
+            self._count("response_cache_misses")
+        else:
+            self._count("response_cache_hits")
+        return value
+
+    def invalidate(self, range_=None):
+        """Drops the entries of `range_`, of all ranges if None."""
+        if range_ is None:
+            self._values.clear()
+            return
+        for key in [key for key in self._values if key[0] == range_]:
+            del self._values[key]
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.inc(name)
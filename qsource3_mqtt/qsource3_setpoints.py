@@ -0,0 +1,41 @@
+class QSource3SetpointTable:
+    """Lookup table of the register writes that apply an m/z on one range.
+
+    Quadrupole derives the RF amplitude and DC voltages of an m/z from the
+    calibration points, the DC offset, the DC flag and the rod polarity. The
+    table keeps the register writes it made for each m/z, so applying a known
+    m/z again replays them without recomputing, and the (RF amplitude, DC1,
+    DC2) setpoints once they are known. The owner clears the table whenever
+    one of these settings changes, so an entry always matches what the
+    device gets for its m/z. A full table drops its oldest entry.
+    """
+
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self._table = {}
+
+    def __len__(self):
+        return len(self._table)
+
+    def get(self, mz):
+        """Returns the (name, args) register writes of `mz`, None if unknown."""
+        entry = self._table.get(mz)
+        return None if entry is None else entry[0]
+
+    def put(self, mz, writes, setpoints=None):
+        if mz not in self._table and len(self._table) >= self.max_size:
+            del self._table[next(iter(self._table))]
+        self._table[mz] = [writes, setpoints]
+
+    def get_setpoints(self, mz):
+        """Returns the (rf_amp, dc1, dc2) setpoints of `mz`, None if unknown."""
+        entry = self._table.get(mz)
+        return None if entry is None else entry[1]
+
+    def put_setpoints(self, mz, setpoints):
+        """Stores the setpoints of `mz`, which must have its writes in the table."""
+        if mz in self._table:
+            self._table[mz][1] = setpoints
+
+    def clear(self):
+        self._table.clear()
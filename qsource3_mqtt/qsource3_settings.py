@@ -0,0 +1,92 @@
+import copy
+import json
+import logging
+import os
+import stat
+import tempfile
+from threading import Lock, Timer
+
+logger = logging.getLogger(__name__)
+
+
+class QSource3SettingsStore:
+    """Persists the QSource3 settings dictionary to a JSON file.
+
+    `save` only records a snapshot of the settings. The snapshot is written
+    by a background timer `delay` seconds after the first unsaved change, so
+    a burst of setter calls results in a single write. Files are replaced
+    atomically, a crash during the write leaves the previous file intact.
+    """
+
+    def __init__(self, settings_file, delay=0.5, metrics=None):
+        self.settings_file = settings_file
+        self.delay = delay
+        self.metrics = metrics
+        self._pending = None
+        self._timer = None
+        self._lock = Lock()
+        self._write_lock = Lock()
+
+    def load(self):
+        # return None if settings file does not exist
+        try:
+            with open(self.settings_file, "r") as f:
+                logger.info(f"Loading settings from {self.settings_file}")
+                return json.load(f)
+        except FileNotFoundError:
+            logger.info(f"Settings file {self.settings_file} not found")
+            return None
+
+    def save(self, settings):
+        with self._lock:
+            self._pending = copy.deepcopy(settings)
+            if self._timer is None:
+                self._timer = Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Writes the unsaved settings, if any, right away."""
+        with self._write_lock:
+            with self._lock:
+                settings = self._pending
+                self._pending = None
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if settings is not None:
+                if self.metrics is None:
+                    self._write(settings)
+                else:
+                    with self.metrics.timed("save_settings"):
+                        self._write(settings)
+
+    def close(self):
+        self.flush()
+
+    def _write(self, settings):
+        directory = os.path.dirname(os.path.abspath(self.settings_file))
+        fd, tmp_path = tempfile.mkstemp(
+            dir=directory,
+            prefix=os.path.basename(self.settings_file) + ".",
+            suffix=".tmp",
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(settings, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            # mkstemp creates the file with mode 0600, the replaced file keeps its mode
+            try:
+                mode = stat.S_IMODE(os.stat(self.settings_file).st_mode)
+            except FileNotFoundError:
+                mode = 0o644
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, self.settings_file)
+            logger.debug(f"Settings saved to {self.settings_file}")
+        except OSError as e:
+            logger.error(f"Could not save settings to {self.settings_file}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -0,0 +1,109 @@
+import logging
+import random
+import time
+
+from pyvisa import VisaIOError
+from pyvisa.constants import StatusCode
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedQSource3Driver:
+    """Stand-in for QSource3Driver that needs no generator on the serial port.
+
+    Every transaction (range switch, register read or write) sleeps for
+    `latency` seconds and fails with a VisaIOError with probability
+    `failure_rate`, which lets the connect/recover path and the throughput
+    of the client be measured without hardware. Register writes made by
+    Quadrupole through `set_*` methods or attributes are stored and read back.
+    `write_registers` models a link that pipelines a batch of writes.
+    """
+
+    def __init__(
+        self,
+        comport,
+        latency=0.0,
+        failure_rate=0.0,
+        frequencies=(1050e3, 480e3, 240e3),
+        current=150.0,
+        seed=None,
+    ):
+        self.registers = {}
+        self.comport = comport
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.frequencies = frequencies
+        self.nominal_current = current
+        self.transactions = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._range = 0
+        self._transaction("open")
+        self._initialized = True
+
+    def _transaction(self, name):
+        self.transactions += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.failure_rate > 0 and self._random.random() < self.failure_rate:
+            self.failures += 1
+            logger.debug(f"Simulated failure of {name} on {self.comport}")
+            raise VisaIOError(StatusCode.error_timeout)
+
+    def set_range(self, value):
+        self._transaction("set_range")
+        self._range = value
+
+    @property
+    def frequency(self):
+        self._transaction("frequency")
+        return self.frequencies[self._range]
+
+    @property
+    def current(self):
+        self._transaction("current")
+        return self.nominal_current * (1 + self._random.uniform(-0.01, 0.01))
+
+    def write_registers(self, writes):
+        """Sends the (name, args) register writes pipelined, without waiting for each ack.
+
+        The batch pays the latency once, each write fails with probability
+        `failure_rate`. Returns the errors of the failed registers by name.
+        """
+        self.transactions += len(writes)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        errors = {}
+        for name, args in writes:
+            if self.failure_rate > 0 and self._random.random() < self.failure_rate:
+                self.failures += 1
+                errors[name] = VisaIOError(StatusCode.error_timeout)
+            elif name == "set_range":
+                self._range = args[0]
+            else:
+                register = name[4:] if name.startswith("set_") else name
+                self.registers[register] = args[0] if len(args) == 1 else args
+        return errors
+
+    def __getattr__(self, name):
+        # called only for names that are not defined above
+        registers = object.__getattribute__(self, "registers")
+        if name.startswith("set_"):
+
+            def write(*args):
+                self._transaction(name)
+                registers[name[4:]] = args[0] if len(args) == 1 else args
+
+            return write
+        if name in registers:
+            self._transaction(name)
+            return registers[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        # attributes created after __init__ are registers written by Quadrupole
+        if self.__dict__.get("_initialized") and name not in self.__dict__:
+            self._transaction(name)
+            self.registers[name] = value
+        else:
+            object.__setattr__(self, name, value)
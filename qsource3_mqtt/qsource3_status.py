@@ -0,0 +1,70 @@
+import time
+
+STATUS_MODES = ("full", "changed", "delta")
+
+
+class QSource3StatusFilter:
+    """Decides which status values are published.
+
+    `full` publishes every status. `changed` publishes the full status only
+    when a value changed since the last publish, `delta` publishes only the
+    changed values. In both modes a full status is still published at least
+    every `heartbeat` seconds. A numeric value whose field has a deadband
+    counts as changed when it differs from the last published value by more
+    than the deadband. `fields` restricts the published values.
+    """
+
+    def __init__(self, mode="full", fields=None, deadbands=None, heartbeat=10.0):
+        if mode not in STATUS_MODES:
+            raise ValueError(
+                f"Invalid status mode {mode}, expected one of {STATUS_MODES}"
+            )
+        self.mode = mode
+        self.fields = fields
+        self.deadbands = deadbands or {}
+        self.heartbeat = heartbeat
+        self._published = {}
+        self._full_time = None
+
+    def reset(self):
+        """Publishes the full status next time, e.g. after the broker reconnected."""
+        self._full_time = None
+
+    def filter(self, status, now=None):
+        """Returns the payload to publish for `status`, None if nothing is due."""
+        if self.fields is not None:
+            status = {field: status[field] for field in self.fields if field in status}
+        if self.mode == "full":
+            return status
+
+        if now is None:
+            now = time.monotonic()
+        changed = {
+            field: value
+            for field, value in status.items()
+            if self._is_changed(field, value)
+        }
+        heartbeat_due = (
+            self._full_time is None or now - self._full_time >= self.heartbeat
+        )
+        if heartbeat_due or (changed and self.mode == "changed"):
+            self._published = dict(status)
+            self._full_time = now
+            return status
+        if not changed:
+            return None
+        self._published.update(changed)
+        return changed
+
+    def _is_changed(self, field, value):
+        if field not in self._published:
+            return True
+        published = self._published[field]
+        deadband = self.deadbands.get(field)
+        if (
+            deadband is not None
+            and isinstance(value, (int, float))
+            and isinstance(published, (int, float))
+        ):
+            return abs(value - published) > deadband
+        return value != published
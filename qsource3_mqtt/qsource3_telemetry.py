@@ -0,0 +1,52 @@
+from array import array
+
+TELEMETRY_FIELDS = ("current", "rf_amp", "dc1", "dc2")
+
+
+class QSource3TelemetryBuffer:
+    """Preallocated ring buffer of timestamped telemetry samples.
+
+    Each field and the timestamps are kept in an `array` of doubles of
+    `capacity` samples, so the memory does not grow while the samples cannot
+    be published. A full buffer overwrites its oldest sample and counts it
+    in `dropped`.
+    """
+
+    def __init__(self, fields=TELEMETRY_FIELDS, capacity=10000):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.values = {field: array("d", bytes(8 * capacity)) for field in fields}
+        self.dropped = 0
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, values):
+        """Stores one sample, `values` are ordered like `fields`."""
+        idx = (self._start + self._count) % self.capacity
+        if self._count == self.capacity:
+            self._start = (self._start + 1) % self.capacity
+            self.dropped += 1
+        else:
+            self._count += 1
+        self.times[idx] = timestamp
+        for field, value in zip(self.fields, values):
+            self.values[field][idx] = value
+
+    def drain(self, limit=None):
+        """Removes up to `limit` of the oldest samples and returns (times, {field: values})."""
+        count = self._count if limit is None else min(limit, self._count)
+        times = self._take(self.times, count)
+        values = {field: self._take(self.values[field], count) for field in self.fields}
+        self._start = (self._start + count) % self.capacity
+        self._count -= count
+        return times, values
+
+    def _take(self, column, count):
+        end = self._start + count
+        if end <= self.capacity:
+            return column[self._start : end].tolist()
+        return column[self._start :].tolist() + column[: end - self.capacity].tolist()
@@ -0,0 +1,49 @@
+from collections import deque
+
+TRIGGER_FIELDS = ("seq", "event", "t", "mz", "rf_amp", "dc1", "dc2")
+
+
+class QSource3TriggerStream:
+    """Buffered trigger events of the setpoints applied by scans and SIM programs.
+
+    Each applied m/z is a `setpoint` event with a sequence number, the
+    monotonic time it was applied and the applied RF amplitude and DC
+    voltages. Its `settled` event repeats the sequence number and values
+    with the time the setpoint has settled. At most `capacity` events are
+    kept, a full buffer drops its oldest event and counts it in `dropped`.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.seq = 0
+        self.dropped = 0
+        self._events = deque()
+
+    def __len__(self):
+        return len(self._events)
+
+    def setpoint(self, t, mz, setpoints):
+        """Records an applied m/z and returns its event."""
+        self.seq += 1
+        event = (self.seq, "setpoint", t, mz, *setpoints)
+        self._append(event)
+        return event
+
+    def settled(self, event, t):
+        """Records that the setpoint of `event` has settled at time `t`."""
+        self._append((event[0], "settled", t, *event[3:]))
+
+    def drain(self, limit=None):
+        """Removes up to `limit` of the oldest events and returns them as {field: values}."""
+        count = len(self._events) if limit is None else min(limit, len(self._events))
+        events = [self._events.popleft() for _ in range(count)]
+        return {
+            field: [event[idx] for event in events]
+            for idx, field in enumerate(TRIGGER_FIELDS)
+        }
+
+    def _append(self, event):
+        if len(self._events) >= self.capacity:
+            self._events.popleft()
+            self.dropped += 1
+        self._events.append(event)
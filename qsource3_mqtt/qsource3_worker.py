@@ -0,0 +1,183 @@
+import logging
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    __slots__ = ("fn", "args", "kwargs", "key")
+
+    def __init__(self, fn, args, kwargs, key=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+
+
+class QSource3Worker:
+    """Runs device jobs on a single thread that owns the QSource3 driver.
+
+    The MQTT network loop only enqueues jobs with `submit`, so slow serial
+    transactions never block keepalives, incoming commands or publishes.
+    `idle()` is called whenever no job is queued and returns the number of
+    seconds to wait for a job before it is called again.
+    """
+
+    def __init__(self, name="qsource3-worker", idle=None):
+        self.idle = idle
+        self._jobs = deque()
+        self._cond = Condition()
+        self._stopped = False
+        self._thread = Thread(target=self._run, name=name, daemon=True)
+        self.coalesced = 0  # number of jobs merged into a newer one
+        # key -> queued coalesced job that a newer job of the key is merged into
+        self._coalescible = {}
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._jobs.clear()
+            self._coalescible.clear()
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues `fn(*args, **kwargs)`, no coalesced job is merged across it."""
+        with self._cond:
+            self._coalescible.clear()
+            self._append(_Job(fn, args, kwargs))
+
+    def submit_read(self, fn, *args, **kwargs):
+        """Queues a job that changes no device state, e.g. a query or a status request.
+
+        Later coalesced jobs are merged across it into the queued job of their key.
+        """
+        self._put(_Job(fn, args, kwargs))
+
+    def call(self, fn, *args, **kwargs):
+        """Queues `fn` and returns a `concurrent.futures.Future` of its result."""
+        future = Future()
+
+        def job():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+        job.__name__ = fn.__name__
+        if self._stopped:
+            future.cancel()
+        else:
+            self.submit(job)
+        return future
+
+    def submit_coalesced(self, key, fn, *args):
+        """Queues `fn(*args, superseded=[...])`, merging it into the queued job of the same `key`.
+
+        The job is merged into the queued job of `key` unless a job of
+        `submit` or of another key was queued after that one, only reads
+        (`submit_read`) may be passed. A merged job keeps its place in the
+        queue and runs only once with the newest `args`. The last positional
+        argument (the request payload) of every job it replaced is collected
+        in `superseded`, oldest first, so each request can still be answered.
+        """
+        with self._cond:
+            job = self._coalescible.get(key)
+            if job is not None:
+                job.kwargs["superseded"].append(job.args[-1])
+                job.args = args
+                self.coalesced += 1
+                return
+            job = _Job(fn, args, {"superseded": []}, key)
+            # a write of another key must not run before this one
+            self._coalescible.clear()
+            if not self._stopped:
+                self._coalescible[key] = job
+            self._append(job)
+
+    def pending(self):
+        return len(self._jobs)
+
+    def run_pending(self, timeout, stop_event=None):
+        """Runs queued jobs for up to `timeout` seconds.
+
+        Called from long running jobs (e.g. a scan dwell) to keep serving
+        commands. The jobs queued on entry run even when `timeout` has passed,
+        else a scan or an endless SIM program with a zero dwell would hold
+        them back. Returns early when `stop_event` is set or the worker stops.
+        """
+        deadline = monotonic() + timeout
+        queued = len(self._jobs)
+        while not self._stopped:
+            if stop_event is not None and stop_event.is_set():
+                return
+            remaining = max(0.0, deadline - monotonic())
+            if remaining == 0 and queued <= 0:
+                return
+            job = self._get(remaining)
+            if job is None:
+                return
+            if stop_event is not None and stop_event.is_set():
+                # the job that stopped the caller runs after the caller returned
+                with self._cond:
+                    self._jobs.appendleft(job)
+                return
+            queued -= 1
+            self._execute(job)
+
+    def _put(self, job):
+        with self._cond:
+            self._append(job)
+
+    def _append(self, job):
+        # called with self._cond held
+        if self._stopped:
+            logger.debug(f"Worker stopped, dropping job {job.fn.__name__}")
+            return
+        self._jobs.append(job)
+        self._cond.notify()
+
+    def _get(self, timeout=None):
+        with self._cond:
+            self._cond.wait_for(lambda: self._jobs or self._stopped, timeout)
+            if self._stopped or not self._jobs:
+                return None
+            job = self._jobs.popleft()
+            if job.key is not None and self._coalescible.get(job.key) is job:
+                del self._coalescible[job.key]  # running, not merged into anymore
+            return job
+
+    def _run(self):
+        delay = 0.0
+        while True:
+            job = self._get(None if self.idle is None else delay)
+            if job is not None:
+                self._execute(job)
+                delay = 0.0  # the job may have changed what the idle job waits for
+            elif self._stopped:
+                break
+            elif self.idle is not None:
+                delay = self._run_idle()
+        logger.debug("Worker stopped")
+
+    def _run_idle(self):
+        try:
+            return self.idle()
+        except Exception:
+            logger.exception("Unhandled error in worker idle job")
+            return 1.0
+
+    def _execute(self, job):
+        try:
+            job.fn(*job.args, **job.kwargs)
+        except Exception:
+            logger.exception(f"Unhandled error in worker job {job.fn.__name__}")
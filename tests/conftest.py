@@ -0,0 +1,11 @@
+import pytest
+
+from helpers import make_client
+
+
+@pytest.fixture
+def client(tmp_path):
+    """Client with the default configuration on the simulated driver."""
+    client = make_client(tmp_path)
+    yield client
+    client.stop()
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+
+import yaml
+
+from qsource3_mqtt.qsource3_mqtt_client import QSource3MQTTClient
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.yaml")
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = json.dumps(payload).encode()
+
+
+class MessageInfo:
+    rc = 0  # MQTT_ERR_SUCCESS
+
+
+class RecordingMQTTClient:
+    """Stand-in for the paho client that records the published messages."""
+
+    def __init__(self):
+        self.published = []
+        self.qos = []
+        self.subscribed = []
+        self.lock = threading.Lock()
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self.lock:
+            self.published.append((topic, payload))
+            self.qos.append(qos)
+        return MessageInfo()
+
+    def subscribe(self, topic, qos=0):
+        self.subscribed.append((topic, qos))
+
+    def responses(self, command, sender_id=None):
+        with self.lock:
+            messages = [
+                json.loads(payload)
+                for topic, payload in self.published
+                if topic.endswith(f"/response/QSource3/{command}")
+            ]
+        return [
+            message["value"]
+            for message in messages
+            if sender_id is None or message["sender_payload"].get("id") == sender_id
+        ]
+
+
+def make_client(tmp_path, **options):
+    """Client with the default configuration and `options` on the simulated driver."""
+    with open(CONFIG_FILE) as file:
+        config = yaml.safe_load(file)
+    config["simulator"] = {"latency": 0.5}
+    config["settings_file"] = str(tmp_path / "settings.json")
+    config["metrics_interval"] = 0
+    config.update(options)
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(yaml.safe_dump(config))
+
+    client = QSource3MQTTClient(str(config_file))
+    client.client = RecordingMQTTClient()
+    return client
+
+
+def send(client, command, payload):
+    client.on_message(None, None, Message(f"qsource3/cmnd/QSource3/{command}", payload))
+
+
+def wait_for_state(client, command, states, sender_id=None, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for value in client.client.responses(command, sender_id):
+            if value.get("state") in states:
+                return value
+        time.sleep(0.01)
+    raise AssertionError(f"No {states} response of {command}")
+
+
+def wait_for_response(client, command, sender_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        responses = client.client.responses(command, sender_id)
+        if responses:
+            return responses[0]
+        time.sleep(0.01)
+    raise AssertionError(f"No response of {command}")
+
+
+def block_worker(client):
+    """Keeps the device worker busy until the returned event is set."""
+    release = threading.Event()
+    client.devices["QSource3"].worker.submit(release.wait, 5)
+    return release
+
+
+def request(client, command, sender_id, value=None):
+    """Sends a query (or a write of `value`) and returns its response."""
+    payload = {"id": sender_id}
+    if value is not None:
+        payload["value"] = value
+    send(client, command, payload)
+    return wait_for_response(client, command, sender_id)
+
+
+def cache_counter(client, name):
+    return client.devices["QSource3"].metrics.counters.get(f"response_cache_{name}", 0)
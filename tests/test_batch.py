@@ -0,0 +1,109 @@
+import pytest
+from pyvisa import VisaIOError
+from pyvisa.constants import StatusCode
+
+from qsource3_mqtt.qsource3_batch import BatchingDriver, QSource3WriteError
+
+
+class SerialDriver:
+    """Driver without pipelined writes whose `failing` registers time out."""
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.written = []
+
+    def __getattr__(self, name):
+        if not name.startswith("set_"):
+            raise AttributeError(name)
+
+        def write(*args):
+            if name in self.failing:
+                raise VisaIOError(StatusCode.error_timeout)
+            self.written.append(name)
+
+        return write
+
+
+def test_serial_batch_stops_at_the_first_failed_write():
+    driver = SerialDriver(failing=("set_range",))
+    batching = BatchingDriver(driver)
+    with pytest.raises(QSource3WriteError) as info:
+        with batching.batch():
+            batching.set_dc1(1)
+            batching.set_range(1)
+            batching.set_rf_amp(100)
+            batching.set_dc2(2)
+    assert driver.written == ["set_dc1"]
+    assert list(info.value.errors) == ["set_range"]
+    assert info.value.unwritten == ["set_range", "set_rf_amp", "set_dc2"]
+
+
+def test_serial_batch_does_not_hide_programming_errors():
+    class BrokenDriver(SerialDriver):
+        def set_dc1(self, value):
+            raise TypeError("bug")
+
+    batching = BatchingDriver(BrokenDriver())
+    with pytest.raises(TypeError):
+        with batching.batch():
+            batching.set_dc1(1)
+
+
+
+class PipelinedDriver:
+    """Driver with pipelined writes that records each batch."""
+
+    def __init__(self):
+        self.batches = []
+
+    def write_registers(self, writes):
+        self.batches.append(writes)
+        return {}
+
+
+def test_rewritten_register_moves_to_the_end_of_the_batch():
+    driver = PipelinedDriver()
+    batching = BatchingDriver(driver)
+    with batching.batch():
+        batching.set_dc1(1)
+        batching.set_dc2(2)
+        batching.set_dc1(3)
+    assert driver.batches == [[("set_dc2", (2,)), ("set_dc1", (3,))]]
+
+
+def test_write_before_a_range_switch_is_kept():
+    driver = PipelinedDriver()
+    batching = BatchingDriver(driver)
+    with batching.batch():
+        batching.set_dc1(1)
+        batching.set_range(1)
+        batching.rf_amp = 100
+        batching.set_dc1(2)
+        batching.rf_amp = 200
+        batching.set_range(0)
+    assert driver.batches == [
+        [
+            ("set_dc1", (1,)),
+            ("set_range", (1,)),
+            ("set_dc1", (2,)),
+            ("rf_amp", (200,)),
+            ("set_range", (0,)),
+        ]
+    ]
+
+
+def test_queued_write_with_keyword_arguments_is_rejected():
+    batching = BatchingDriver(PipelinedDriver())
+    with batching.batch():
+        with pytest.raises(TypeError):
+            batching.set_dc1(value=1)
+
+
+def test_captured_writes_keep_their_order():
+    driver = PipelinedDriver()
+    batching = BatchingDriver(driver)
+    with batching.capture() as writes:
+        batching.set_dc2(2)
+        batching.set_dc1(1)
+    assert writes == [("set_dc2", (2,)), ("set_dc1", (1,))]
+    assert driver.batches == []
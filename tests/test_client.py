@@ -0,0 +1,112 @@
+import json
+import time
+
+import pytest
+
+from helpers import Message, make_client
+
+
+def test_outbox_replays_messages_with_their_qos(client):
+    recording = client.client
+    client.client = None  # before create_client
+    client.publish("qsource3/connected/QSource3", "true", "connected", retain=True)
+    client.publish("qsource3/status/QSource3", "{}", "status")
+    client.client = recording
+    client.flush_outbox()
+    assert recording.published[-2:] == [
+        ("qsource3/connected/QSource3", "true"),
+        ("qsource3/status/QSource3", "{}"),
+    ]
+    assert recording.qos[-2:] == [1, 0]
+
+
+def test_commands_are_subscribed_on_a_resumed_session(client):
+    client.on_connect(None, None, {"session present": True}, 0)
+    assert client.client.subscribed == [("qsource3/cmnd/QSource3/#", 0)]
+
+
+def test_trigger_events_buffered_offline_are_published_on_reconnect(tmp_path):
+    client = make_client(tmp_path, trigger={})
+    try:
+        device = client.devices["QSource3"]
+        recording = client.client
+        client.client = None  # broker unreachable
+        device.worker.call(
+            device.trigger_stream.setpoint, time.monotonic(), 10, (1.0, 2.0, 3.0)
+        ).result()
+        device.worker.call(device.publish_triggers).result()
+        client.client = recording
+        client.on_connect(None, None, {}, 0)
+        device.worker.call(lambda: None).result()  # after the queued jobs
+        triggers = [
+            json.loads(payload)
+            for topic, payload in recording.published
+            if topic == "qsource3/trigger/QSource3"
+        ]
+        assert [trigger["mz"] for trigger in triggers] == [[10]]
+    finally:
+        client.stop()
+
+
+def test_commands_are_routed_to_their_device(tmp_path):
+    client = make_client(tmp_path, devices=[{"device_name": "A"}, {"device_name": "B"}])
+    try:
+        calls = []
+        for name, device in client.devices.items():
+            device.on_command = lambda command, payload, name=name: calls.append(
+                (name, command, payload)
+            )
+        topics = ("qsource3/cmnd/B/mz", "qsource3/cmnd/A/range", "qsource3/cmnd/C/mz")
+        for topic in topics:
+            client.on_message(None, None, Message(topic, {"id": 1}))
+        client.on_message(None, None, Message("other/cmnd/A/mz", {"id": 2}))
+        assert calls == [("B", "mz", {"id": 1}), ("A", "range", {"id": 1})]
+    finally:
+        client.stop()
+
+
+def test_devices_get_their_own_settings_file(tmp_path):
+    client = make_client(
+        tmp_path,
+        devices=[
+            {"device_name": "A"},
+            {"device_name": "B"},
+            {"device_name": "C", "settings_file": str(tmp_path / "c.json")},
+        ],
+    )
+    try:
+        files = {
+            name: device.qsource3.settings_file
+            for name, device in client.devices.items()
+        }
+        assert files == {
+            "A": str(tmp_path / "settings_A.json"),
+            "B": str(tmp_path / "settings_B.json"),
+            "C": str(tmp_path / "c.json"),
+        }
+    finally:
+        client.stop()
+
+
+def test_single_device_keeps_the_settings_file(tmp_path):
+    client = make_client(tmp_path, devices=[{"device_name": "A"}])
+    try:
+        settings_file = client.devices["A"].qsource3.settings_file
+        assert settings_file == str(tmp_path / "settings.json")
+    finally:
+        client.stop()
+
+
+@pytest.mark.parametrize(
+    "devices",
+    [
+        [{"device_name": "A"}, {"device_name": "A"}],
+        [
+            {"device_name": "A", "settings_file": "same.json"},
+            {"device_name": "B", "settings_file": "same.json"},
+        ],
+    ],
+)
+def test_devices_sharing_a_name_or_settings_file_are_rejected(tmp_path, devices):
+    with pytest.raises(ValueError):
+        make_client(tmp_path, devices=devices)
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from qsource3_mqtt import qsource3_codec
+from qsource3_mqtt.qsource3_codec import decode, encode, encode_response
+
+PAYLOAD = {"value": [1.5, 2, "x", True, None], "sender_payload": {"id": 7}}
+
+STATUS = {
+    "range": 1,
+    "frequency": 480e3,
+    "rf_amp": 120.5,
+    "dc1": 10.25,
+    "dc2": -10.25,
+    "current": 150.0,
+    "mz": 42.0,
+    "is_dc_on": True,
+    "is_rod_polarity_positive": False,
+    "max_mz": 300.0,
+}
+
+
+# the map encodings whose package is installed
+ENCODINGS = [
+    encoding
+    for encoding, package in (
+        ("json", json),
+        ("msgpack", qsource3_codec.msgpack),
+        ("cbor", qsource3_codec.cbor2),
+    )
+    if package is not None
+]
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_round_trip_and_detection(encoding):
+    assert decode(encode(PAYLOAD, encoding)) == PAYLOAD
+
+
+def test_status_record_round_trip():
+    data = encode(STATUS, "struct")
+    assert data.startswith(b"QS3")
+    assert decode(data) == STATUS
+
+
+def test_status_record_keeps_only_the_present_fields():
+    status = {"mz": 12.5, "is_dc_on": False}
+    assert decode(encode(status, "struct")) == status
+
+
+def test_json_text_is_decoded():
+    assert decode('{"value": 1}') == {"value": 1}
+
+
+@pytest.mark.parametrize(
+    "data",
+    [b"", b"garbage", b"\xff\xfe", b"QS3", b"QS3\x01\x00", b'{"value": '],
+)
+def test_garbage_is_rejected_with_a_value_error(data):
+    with pytest.raises(ValueError):
+        decode(data)
+
+
+def test_status_record_of_another_version_is_rejected():
+    data = bytearray(encode(STATUS, "struct"))
+    data[3] = 2
+    with pytest.raises(ValueError):
+        decode(bytes(data))
+
+
+@pytest.mark.parametrize(
+    "value, sender_payload",
+    [
+        (3.5, {"id": 1}),
+        ({"error": "Invalid value"}, {"id": "a", "value": [1, 2]}),
+        ([[0, 1], [100, 2]], {}),
+        (None, {"value": True}),
+    ],
+)
+def test_json_response_equals_the_previous_encoding(value, sender_payload):
+    # before the response cache the whole dictionary was encoded per request
+    previous = json.dumps({"value": value, "sender_payload": sender_payload})
+    assert encode_response(encode(value), sender_payload) == previous
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS[1:])
+def test_binary_response_equals_the_encoding_of_the_whole_map(encoding):
+    value = {"error": "Invalid value"}
+    sender_payload = {"id": 3}
+    response = encode_response(encode(value, encoding), sender_payload, encoding)
+    assert response == encode(
+        {"value": value, "sender_payload": sender_payload}, encoding
+    )
@@ -0,0 +1,439 @@
+import time
+
+import pytest
+from pyvisa import VisaIOError
+from pyvisa.constants import StatusCode
+
+from qsource3_mqtt.qsource3_logic import QSource3NotConnectedException
+
+from helpers import (
+    block_worker,
+    cache_counter,
+    make_client,
+    request,
+    send,
+    wait_for_response,
+    wait_for_state,
+)
+
+
+def test_scan_finishes_with_default_config(client):
+    send(client, "scan", {"value": {"start": 10, "stop": 12, "step": 1, "dwell": 2}})
+    assert wait_for_state(client, "scan", ("finished",))["count"] == 3
+
+
+def test_sim_finishes_with_default_config(client):
+    program = {"points": [{"mz": 10, "dwell": 2}, {"mz": 20, "dwell": 2}], "cycles": 2}
+    send(client, "sim", {"value": program})
+    assert wait_for_state(client, "sim", ("finished",))["cycles"] == 2
+
+
+@pytest.mark.parametrize(
+    "command, program",
+    [
+        ("scan", {"start": 10, "stop": 20, "step": 1, "dwell": 20}),
+        ("sim", {"points": [{"mz": 10, "dwell": 20}], "cycles": 10}),
+    ],
+)
+def test_queued_run_is_stopped_by_a_newer_one(client, command, program):
+    release = block_worker(client)
+    send(client, command, {"id": 1, "value": program})
+    send(client, command, {"id": 2, "value": {**program, "cycles": 1}})
+    release.set()
+    assert wait_for_state(client, command, ("finished",), sender_id=2)
+    assert client.client.responses(command, 1)[-1]["state"] == "aborted"
+
+
+@pytest.mark.parametrize("command", ["scan", "sim"])
+def test_queued_run_is_stopped_by_abort(client, command):
+    program = {"start": 10, "stop": 20, "step": 1, "dwell": 20}
+    if command == "sim":
+        program = {"points": [{"mz": 10, "dwell": 20}], "cycles": 10}
+    release = block_worker(client)
+    send(client, command, {"id": 1, "value": program})
+    send(client, command, {"id": 2, "value": {"abort": True}})
+    release.set()
+    assert wait_for_state(client, command, ("aborted",), sender_id=1)
+
+
+def test_endless_sim_stopped_in_its_first_cycle_is_aborted(client):
+    program = {"points": [{"mz": 10, "dwell": 1000}], "cycles": 0}
+    send(client, "sim", {"id": 1, "value": program})
+    device = client.devices["QSource3"]
+    deadline = time.monotonic() + 5
+    while not device.sim_running and time.monotonic() < deadline:
+        time.sleep(0.01)
+    send(client, "sim", {"id": 2, "value": {"abort": True}})
+    assert wait_for_state(client, "sim", ("finished", "aborted"), sender_id=1) == {
+        "state": "aborted",
+        "cycles": 0,
+    }
+
+
+def test_sim_with_invalid_points_is_answered_with_an_error(client):
+    send(client, "sim", {"value": {"points": [10, 20], "dwell": 2}})
+    assert "error" in wait_for_state(client, "sim", ("error",))
+
+
+@pytest.mark.parametrize(
+    "batch",
+    [
+        {"dc_offst": "7", "mz": 20},
+        {"is_dc_on": "yes"},
+        {"calib_pnts_dc": [[1, 2, 3]]},
+        {"range": 5},
+        {"range": True},
+        {"mz": False},
+        {"mz": float("nan")},
+        {"dc_offst": float("inf")},
+    ],
+)
+def test_invalid_batch_is_rejected_as_a_whole(client, batch):
+    send(client, "batch", {"id": 1, "value": {"range": 1, "dc_offst": 3, **batch}})
+    send(client, "batch", {"id": 2})
+    parameters = wait_for_response(client, "batch", 2)
+    assert "error" in client.client.responses("batch", 1)[0]
+    assert parameters["range"] == 0
+    assert parameters["dc_offst"] == 0
+
+
+def test_batch_failing_after_the_range_switch_is_answered_and_reverted(client):
+    send(client, "batch", {"id": 1})
+    wait_for_response(client, "batch", 1)  # connected
+    logic = client.devices["QSource3"].qsource3
+    apply_mz = logic._apply_mz
+
+    def fail_once(idx, value):
+        logic._apply_mz = apply_mz
+        raise RuntimeError("bug")
+
+    logic._apply_mz = fail_once
+    send(client, "batch", {"id": 2, "value": {"range": 1, "dc_offst": 3}})
+    send(client, "batch", {"id": 3})
+    parameters = wait_for_response(client, "batch", 3)
+    assert client.client.responses("batch", 2) == [{"error": "bug"}]
+    assert parameters["range"] == 0
+    assert parameters["dc_offst"] == 0
+    assert logic.current_range == logic.settings["range"] == 0
+
+
+@pytest.mark.parametrize("command", ["range", "mz", "dc_offst"])
+def test_boolean_is_not_accepted_as_a_number(client, command):
+    send(client, command, {"id": 1, "value": True})
+    assert "error" in wait_for_response(client, command, 1)
+    send(client, "range", {"id": 2})
+    assert wait_for_response(client, "range", 2) == 0
+
+
+def test_known_mz_is_replayed_from_the_setpoint_table(client):
+    logic = client.devices["QSource3"].qsource3
+    simulator = None
+    applied = {}
+    for sender_id, mz in ((1, 10), (2, 20), (3, 10)):
+        send(client, "mz", {"id": sender_id, "value": mz})
+        assert wait_for_response(client, "mz", sender_id) == mz
+        simulator = logic.driver._driver._driver
+        applied[sender_id] = dict(simulator.registers)
+    assert applied[2] != applied[1]
+    assert applied[3] == applied[1]
+
+
+def apply_mz_again(client, sender_id, mz):
+    """Returns the registers of `mz` computed from scratch by the Quadrupole."""
+    logic = client.devices["QSource3"].qsource3
+    logic.setpoint_tables[logic.current_range].clear()
+    send(client, "mz", {"id": sender_id, "value": mz})
+    wait_for_response(client, "mz", sender_id)
+    return dict(logic.driver._driver._driver.registers)
+
+
+@pytest.mark.parametrize(
+    "command, value",
+    [("dc_offst", 1), ("is_dc_on", False), ("calib_pnts_rf", [[0, 1], [100, 2]])],
+)
+def test_setting_change_applies_the_reported_mz(client, command, value):
+    logic = client.devices["QSource3"].qsource3
+    for sender_id, mz in ((1, 10), (2, 20), (3, 10)):
+        send(client, "mz", {"id": sender_id, "value": mz})
+        wait_for_response(client, "mz", sender_id)
+    logic.prepare_setpoints([50, 60, 70])  # leaves the Quadrupole at m/z 70
+    send(client, command, {"id": 4, "value": value})
+    wait_for_response(client, command, 4)
+    registers = dict(logic.driver._driver._driver.registers)
+    assert logic.get_status()["mz"] == 10
+    assert registers == apply_mz_again(client, 5, 10)
+
+
+def test_polled_setpoint_is_read_from_the_device(client):
+    logic = client.devices["QSource3"].qsource3
+    logic.poll_intervals["rf_amp"] = 0
+    send(client, "mz", {"id": 1, "value": 10})
+    wait_for_response(client, "mz", 1)
+    simulator = logic.driver._driver._driver
+    assert logic.get_status()["rf_amp"] == simulator.registers["rf_amp"]
+    simulator.registers["rf_amp"] += 1.5  # drift of the generator
+    assert logic.get_status()["rf_amp"] == simulator.registers["rf_amp"]
+
+
+def test_setpoints_of_a_new_mz_are_not_read_back(client):
+    logic = client.devices["QSource3"].qsource3
+    send(client, "mz", {"id": 1, "value": 33})
+    wait_for_response(client, "mz", 1)
+    simulator = logic.driver._driver._driver
+    transactions = simulator.transactions
+    setpoints = logic.get_setpoints()
+    assert simulator.transactions == transactions
+    registers = simulator.registers
+    assert setpoints == (registers["rf_amp"], registers["dc1"], registers["dc2"])
+
+
+@pytest.mark.parametrize(
+    "program",
+    [
+        {"start": 10, "stop": 1e12, "step": 1e-3, "dwell": 1},
+        {"mz_list": [10] * 100001, "dwell": 1},
+    ],
+)
+def test_scan_with_too_many_points_is_answered_with_an_error(client, program):
+    send(client, "scan", {"value": program})
+    assert (
+        "more than 100000 points" in wait_for_state(client, "scan", ("error",))["error"]
+    )
+
+
+@pytest.mark.parametrize(
+    "program",
+    [
+        {"mz_list": [10, float("nan")], "dwell": 1},
+        {"mz_list": [10, float("inf")], "dwell": 1},
+        {"start": 10, "stop": 12, "step": 1, "dwell": float("inf")},
+        {"start": 10, "stop": 12, "step": 1, "dwell": float("nan")},
+    ],
+)
+def test_scan_with_non_finite_values_is_answered_with_an_error(client, program):
+    send(client, "scan", {"value": program})
+    assert "error" in wait_for_state(client, "scan", ("error",))
+
+
+@pytest.mark.parametrize(
+    "program",
+    [
+        {"points": [{"mz": float("nan"), "dwell": 2}], "cycles": 1},
+        {"points": [{"mz": float("inf"), "dwell": 2}], "cycles": 1},
+        {"points": [{"mz": 10, "dwell": float("inf")}], "cycles": 1},
+        {"points": [{"mz": 10}], "dwell": float("nan"), "cycles": 1},
+        {"points": [{"mz": 10, "dwell": 2}], "cycles": 2.5},
+        {"points": [{"mz": 10, "dwell": 2}], "cycles": True},
+    ],
+)
+def test_sim_with_invalid_values_is_answered_with_an_error(client, program):
+    send(client, "sim", {"value": program})
+    assert "error" in wait_for_state(client, "sim", ("error",))
+
+
+def test_write_invalidates_the_cached_responses_of_its_range_only(client):
+    request(client, "range", 1, 1)
+    assert request(client, "dc_offst", 2) == 0  # cached on range 1
+    request(client, "range", 3, 0)
+    assert request(client, "dc_offst", 4) == 0  # cached on range 0
+    misses = cache_counter(client, "misses")
+    assert request(client, "dc_offst", 5, 5) == 5  # read again on range 0
+    assert cache_counter(client, "misses") == misses + 1
+    request(client, "range", 6, 1)
+    hits = cache_counter(client, "hits")
+    assert request(client, "dc_offst", 7) == 0
+    assert cache_counter(client, "hits") == hits + 1
+
+
+def test_batch_invalidates_the_cached_responses_of_all_ranges(client):
+    assert request(client, "dc_offst", 1) == 0  # cached on range 0
+    request(client, "range", 2, 1)
+    assert request(client, "dc_offst", 3) == 0  # cached on range 1
+    request(client, "batch", 4, {"range": 0, "dc_offst": 4})
+    misses = cache_counter(client, "misses")
+    assert request(client, "dc_offst", 5) == 4
+    assert cache_counter(client, "misses") == misses + 1
+    request(client, "range", 6, 1)
+    misses = cache_counter(client, "misses")
+    assert request(client, "dc_offst", 7) == 0
+    assert cache_counter(client, "misses") == misses + 1
+
+
+def test_query_of_a_disconnected_device_bypasses_the_response_cache(client):
+    assert request(client, "dc_offst", 1) == 0  # cached
+    device = client.devices["QSource3"]
+    logic = device.qsource3
+
+    def unreachable(comport):
+        raise VisaIOError(StatusCode.error_timeout)
+
+    def disconnect():
+        logic.driver_factory = unreachable
+        logic._is_connected = False
+
+    device.worker.call(disconnect).result()
+    send(client, "dc_offst", {"id": 2})
+    device.worker.call(lambda: None).result()  # after the query
+    assert client.client.responses("dc_offst", 2) == []
+    assert any(
+        topic == "qsource3/error/QSource3/disconnected"
+        for topic, _ in client.client.published
+    )
+
+
+
+def test_connect_after_a_failed_first_connect_is_not_a_reconnect(tmp_path):
+    client = make_client(tmp_path, connect_on_start=False)
+    try:
+        logic = client.devices["QSource3"].qsource3
+        driver_factory = logic.driver_factory
+
+        def unreachable(comport):
+            raise VisaIOError(StatusCode.error_timeout)
+
+        def connect(factory):
+            logic.driver_factory = factory
+            logic.try_connect()
+            return logic.connect_metrics["reconnect"]
+
+        worker = client.devices["QSource3"].worker
+        with pytest.raises(QSource3NotConnectedException):
+            worker.call(connect, unreachable).result()
+        assert worker.call(connect, driver_factory).result() is False
+        assert worker.call(connect, driver_factory).result() is True
+        counters = logic.metrics.counters
+        assert (counters["connects"], counters["reconnects"]) == (1, 1)
+    finally:
+        client.stop()
+
+def test_queued_writes_are_coalesced_across_queries(client):
+    worker = client.devices["QSource3"].worker
+    release = block_worker(client)
+    for sender_id, mz in ((1, 10), (2, 20), (3, 30)):
+        send(client, "mz", {"id": sender_id, "value": mz})
+        send(client, "max_mz", {"id": sender_id})
+        client.devices["QSource3"].request_status()
+    send(client, "dc_offst", {"id": 4, "value": 1})
+    send(client, "mz", {"id": 5, "value": 40})  # after a write of another setting
+    assert worker.coalesced == 2
+    release.set()
+    assert wait_for_response(client, "mz", 5) == 40
+    # every merged request is answered with the applied value
+    for sender_id in (1, 2, 3):
+        assert client.client.responses("mz", sender_id) == [30]
+    assert client.client.responses("dc_offst", 4) == [1]
+
+
+@pytest.mark.parametrize("command", ["unknown", "mz/extra", ""])
+def test_unregistered_command_is_ignored(client, command):
+    device = client.devices["QSource3"]
+    send(client, command, {"id": 1, "value": 10})
+    device.worker.call(lambda: None).result()  # after any queued job
+    assert not any("/response/" in topic for topic, _ in client.client.published)
+    assert device.metrics.counters["mqtt_messages_in"] == 1
+
+
+def test_command_with_a_payload_that_is_no_object_is_answered_with_an_error(client):
+    send(client, "mz", [10])
+    responses = client.client.responses("mz")
+    assert len(responses) == 1 and "error" in responses[0]
+
+
+def test_endless_sim_without_dwell_serves_queries(client):
+    program = {"points": [{"mz": 10, "dwell": 0}, {"mz": 20, "dwell": 0}], "cycles": 0}
+    send(client, "sim", {"id": 1, "value": program})
+    device = client.devices["QSource3"]
+    deadline = time.monotonic() + 5
+    while not device.sim_running and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert device.sim_running
+    send(client, "max_mz", {"id": 2})
+    assert "error" not in str(wait_for_response(client, "max_mz", 2))
+    send(client, "sim", {"id": 3, "value": {"abort": True}})
+    assert wait_for_state(client, "sim", ("aborted",), sender_id=1)
+
+
+@pytest.mark.parametrize(
+    "name, value",
+    [
+        ("calib_pnts_dc", [[0, 1], [100, 2]]),
+        ("calib_pnts_rf", [[0, 1], [100, 2]]),
+        ("dc_offst", 1),
+    ],
+)
+def test_setting_change_writes_the_registers_in_one_batch(client, name, value):
+    request(client, "mz", 1, 10)
+    device = client.devices["QSource3"]
+    logic = device.qsource3
+    device.worker.call(logic.prepare_setpoints, [50, 60, 70]).result()
+    simulator = logic.driver._driver._driver
+    before = dict(simulator.registers)
+    # registers seen by each transaction and at the start of each batch
+    seen = []
+    batches = []
+    transaction = simulator._transaction
+    write_registers = simulator.write_registers
+
+    def record_transaction(name):
+        seen.append(dict(simulator.registers))
+        transaction(name)
+
+    def record_batch(writes):
+        seen.append(dict(simulator.registers))
+        batches.append(writes)
+        return write_registers(writes)
+
+    object.__setattr__(simulator, "_transaction", record_transaction)
+    object.__setattr__(simulator, "write_registers", record_batch)
+    device.worker.call(setattr, logic, name, value).result()
+    assert len(batches) == 1
+    assert all(registers == before for registers in seen)
+
+
+def test_status_is_answered_while_a_large_scan_starts(client):
+    request(client, "mz", 1, 10)  # connected
+    device = client.devices["QSource3"]
+    program = {"start": 10, "stop": 610, "step": 0.01, "dwell": 1}
+    send(client, "scan", {"id": 2, "value": program})
+    deadline = time.monotonic() + 5
+    while not device.scan_running and time.monotonic() < deadline:
+        time.sleep(0.001)
+    device.request_status()
+    deadline = time.monotonic() + 1
+    while time.monotonic() < deadline:
+        if any(
+            topic == "qsource3/status/QSource3/state"
+            for topic, _ in client.client.published
+        ):
+            break
+        time.sleep(0.01)
+    else:
+        raise AssertionError("No status during the scan")
+    send(client, "scan", {"id": 3, "value": {"abort": True}})
+    assert wait_for_state(client, "scan", ("aborted",), sender_id=2)
+
+
+def test_telemetry_is_sampled_only_while_the_worker_is_idle(tmp_path):
+    client = make_client(tmp_path, telemetry={"sample_interval": 1})
+    try:
+        device = client.devices["QSource3"]
+
+        def samples():
+            return device.metrics.counters.get("telemetry_samples", 0)
+
+        deadline = time.monotonic() + 5
+        while samples() < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert samples() >= 3
+        release = block_worker(client)
+        time.sleep(0.02)  # the sample in progress has finished
+        count = samples()
+        time.sleep(0.1)
+        assert samples() == count
+        release.set()
+        deadline = time.monotonic() + 5
+        while samples() == count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert samples() > count
+    finally:
+        client.stop()
@@ -0,0 +1,90 @@
+import pytest
+
+from qsource3_mqtt.qsource3_metrics import (
+    InstrumentedDriver,
+    QSource3Metrics,
+    to_prometheus,
+)
+
+
+def test_exposition_has_a_type_line_per_family():
+    metrics = QSource3Metrics()
+    metrics.inc("connects")
+    metrics.observe("get_status", 0.003)
+    metrics.observe("get_status", 10.0)
+    metrics.gauge("queue_depth", lambda: 2)
+    metrics.gauge("name", lambda: "not a number")
+    lines = metrics.to_prometheus({"device": "Q1"}).splitlines()
+    assert lines[:2] == [
+        "# TYPE qsource3_connects_total counter",
+        'qsource3_connects_total{device="Q1"} 1',
+    ]
+    assert lines[2] == "# TYPE qsource3_get_status_seconds histogram"
+    buckets = [line for line in lines if "_bucket" in line]
+    assert buckets[3] == 'qsource3_get_status_seconds_bucket{device="Q1",le="0.005"} 1'
+    assert buckets[-1] == 'qsource3_get_status_seconds_bucket{device="Q1",le="+Inf"} 2'
+    assert 'qsource3_get_status_seconds_count{device="Q1"} 2' in lines
+    assert lines[-2:] == [
+        "# TYPE qsource3_queue_depth gauge",
+        'qsource3_queue_depth{device="Q1"} 2.0',
+    ]
+
+
+def test_samples_of_several_devices_share_the_type_line():
+    devices = []
+    for name in ("Q1", "Q2"):
+        metrics = QSource3Metrics()
+        metrics.inc("connects")
+        devices.append(({"device": name}, metrics))
+    assert to_prometheus(devices).splitlines() == [
+        "# TYPE qsource3_connects_total counter",
+        'qsource3_connects_total{device="Q1"} 1',
+        'qsource3_connects_total{device="Q2"} 1',
+    ]
+
+
+class Driver:
+    frequency = 1050e3
+
+    def __init__(self):
+        self.written = []
+
+    def set_range(self, value):
+        self.written.append(("set_range", value))
+
+    @property
+    def current(self):
+        raise ConnectionError("timeout")
+
+    def write_registers(self, writes):
+        return {name: "timeout" for name, _ in writes[:1]}
+
+
+def counters(metrics):
+    return (
+        metrics.counters.get("serial_transactions", 0),
+        metrics.counters.get("serial_errors", 0),
+    )
+
+
+def test_instrumented_driver_counts_transactions_and_errors():
+    metrics = QSource3Metrics()
+    driver = InstrumentedDriver(Driver(), metrics)
+    assert driver.frequency == 1050e3
+    driver.set_range(1)
+    driver.dc1 = 5
+    assert counters(metrics) == (3, 0)
+    with pytest.raises(ConnectionError):
+        driver.current
+    assert counters(metrics) == (4, 1)
+    errors = driver.write_registers([("set_dc1", (1,)), ("set_dc2", (2,))])
+    assert list(errors) == ["set_dc1"]
+    assert counters(metrics) == (6, 2)  # each pipelined register is a transaction
+
+
+def test_missing_attribute_is_no_transaction():
+    metrics = QSource3Metrics()
+    driver = InstrumentedDriver(Driver(), metrics)
+    with pytest.raises(AttributeError):
+        driver.missing
+    assert counters(metrics) == (0, 0)
@@ -0,0 +1,94 @@
+import json
+import os
+import stat
+import time
+
+import pytest
+
+from qsource3_mqtt.qsource3_metrics import QSource3Metrics
+from qsource3_mqtt.qsource3_settings import QSource3SettingsStore
+
+
+@pytest.fixture
+def settings_file(tmp_path):
+    return str(tmp_path / "settings.json")
+
+
+def writes(metrics):
+    histogram = metrics.timings.get("save_settings")
+    return 0 if histogram is None else histogram.count
+
+
+def test_burst_of_saves_is_written_once(settings_file):
+    metrics = QSource3Metrics()
+    store = QSource3SettingsStore(settings_file, delay=0.05, metrics=metrics)
+    settings = {"dc_offst": [0, 0]}
+    for value in range(10):
+        settings["dc_offst"][0] = value
+        store.save(settings)
+    assert not os.path.exists(settings_file)
+    deadline = time.monotonic() + 5
+    while writes(metrics) == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert writes(metrics) == 1
+    assert store.load() == {"dc_offst": [9, 0]}
+
+
+def test_save_keeps_a_snapshot_of_the_settings(settings_file):
+    store = QSource3SettingsStore(settings_file, delay=10)
+    settings = {"range": 0}
+    store.save(settings)
+    settings["range"] = 1  # changed after the save, not saved again
+    store.close()
+    assert store.load() == {"range": 0}
+
+
+def test_close_writes_the_pending_settings_at_once(settings_file):
+    store = QSource3SettingsStore(settings_file, delay=10)
+    store.save({"range": 1})
+    store.close()
+    with open(settings_file) as f:
+        assert json.load(f) == {"range": 1}
+
+
+def test_close_without_pending_settings_writes_nothing(settings_file):
+    QSource3SettingsStore(settings_file, delay=10).close()
+    assert not os.path.exists(settings_file)
+
+
+def test_failed_write_keeps_the_previous_file(settings_file, monkeypatch):
+    store = QSource3SettingsStore(settings_file, delay=10)
+    store.save({"range": 0})
+    store.flush()
+
+    def fail(fd):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "fsync", fail)
+    store.save({"range": 1})
+    store.flush()
+    assert store.load() == {"range": 0}
+    assert os.listdir(os.path.dirname(settings_file)) == ["settings.json"]
+
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_new_file_is_readable_by_everyone(settings_file):
+    store = QSource3SettingsStore(settings_file, delay=10)
+    store.save({"range": 0})
+    store.flush()
+    assert mode(settings_file) == 0o644
+
+
+def test_replaced_file_keeps_its_mode(settings_file):
+    with open(settings_file, "w") as f:
+        json.dump({"range": 0}, f)
+    os.chmod(settings_file, 0o640)
+    store = QSource3SettingsStore(settings_file, delay=10)
+    store.save({"range": 1})
+    store.flush()
+    assert mode(settings_file) == 0o640
+    assert store.load() == {"range": 1}
@@ -0,0 +1,80 @@
+import pytest
+
+from qsource3_mqtt.qsource3_status import QSource3StatusFilter
+
+STATUS = {"range": 0, "mz": 10.0, "current": 150.0, "is_dc_on": True}
+
+
+def test_full_mode_publishes_every_status():
+    status_filter = QSource3StatusFilter("full", fields=["mz", "current"])
+    for now in (0.0, 0.1):
+        assert status_filter.filter(STATUS, now) == {"mz": 10.0, "current": 150.0}
+
+
+def test_changed_mode_suppresses_unchanged_statuses():
+    status_filter = QSource3StatusFilter("changed", heartbeat=10)
+    assert status_filter.filter(STATUS, 0.0) == STATUS
+    assert status_filter.filter(dict(STATUS), 1.0) is None
+    changed = {**STATUS, "mz": 20.0}
+    assert status_filter.filter(changed, 2.0) == changed
+    assert status_filter.filter(changed, 3.0) is None
+
+
+def test_changed_mode_publishes_the_full_status_on_the_heartbeat():
+    status_filter = QSource3StatusFilter("changed", heartbeat=10)
+    status_filter.filter(STATUS, 0.0)
+    assert status_filter.filter(STATUS, 9.9) is None
+    assert status_filter.filter(STATUS, 10.0) == STATUS
+
+
+def test_delta_mode_publishes_the_changed_values_only():
+    status_filter = QSource3StatusFilter("delta", heartbeat=10)
+    assert status_filter.filter(STATUS, 0.0) == STATUS
+    assert status_filter.filter({**STATUS, "is_dc_on": False}, 1.0) == {
+        "is_dc_on": False
+    }
+    assert status_filter.filter({**STATUS, "is_dc_on": False}, 2.0) is None
+
+
+@pytest.mark.parametrize(
+    "current, published",
+    [
+        (150.5, None),
+        (151.0, None),
+        (151.01, {"current": 151.01}),
+        (148.9, {"current": 148.9}),
+    ],
+)
+def test_delta_mode_deadband(current, published):
+    status_filter = QSource3StatusFilter(
+        "delta", deadbands={"current": 1.0}, heartbeat=10
+    )
+    status_filter.filter(STATUS, 0.0)
+    assert status_filter.filter({**STATUS, "current": current}, 1.0) == published
+
+
+def test_deadband_is_measured_from_the_last_published_value():
+    status_filter = QSource3StatusFilter(
+        "delta", deadbands={"current": 1.0}, heartbeat=10
+    )
+    status_filter.filter(STATUS, 0.0)
+    # each step stays within the deadband, their sum does not
+    assert status_filter.filter({**STATUS, "current": 150.6}, 1.0) is None
+    assert status_filter.filter({**STATUS, "current": 151.2}, 2.0) == {
+        "current": 151.2
+    }
+
+
+@pytest.mark.parametrize("mode", ["changed", "delta"])
+def test_reset_forces_a_full_publish(mode):
+    status_filter = QSource3StatusFilter(mode, heartbeat=10)
+    status_filter.filter(STATUS, 0.0)
+    assert status_filter.filter(STATUS, 1.0) is None
+    status_filter.reset()
+    assert status_filter.filter(STATUS, 2.0) == STATUS
+    assert status_filter.filter(STATUS, 3.0) is None
+
+
+def test_invalid_mode_is_rejected():
+    with pytest.raises(ValueError):
+        QSource3StatusFilter("sometimes")
@@ -0,0 +1,39 @@
+from qsource3_mqtt.qsource3_telemetry import QSource3TelemetryBuffer
+
+
+def fill(buffer, times):
+    for t in times:
+        buffer.append(t, [t * 10, t * 100])
+
+
+def test_drain_returns_the_samples_in_order():
+    buffer = QSource3TelemetryBuffer(fields=("current", "rf_amp"), capacity=4)
+    fill(buffer, [1, 2, 3])
+    times, values = buffer.drain()
+    assert times == [1, 2, 3]
+    assert values == {"current": [10, 20, 30], "rf_amp": [100, 200, 300]}
+    assert len(buffer) == 0
+
+
+def test_full_buffer_overwrites_its_oldest_samples():
+    buffer = QSource3TelemetryBuffer(fields=("current", "rf_amp"), capacity=4)
+    fill(buffer, [1, 2, 3, 4, 5, 6])
+    assert len(buffer) == 4
+    assert buffer.dropped == 2
+    times, values = buffer.drain()
+    assert times == [3, 4, 5, 6]
+    assert values["rf_amp"] == [300, 400, 500, 600]
+
+
+def test_drain_with_a_limit_across_the_wraparound():
+    buffer = QSource3TelemetryBuffer(fields=("current", "rf_amp"), capacity=4)
+    fill(buffer, [1, 2, 3])
+    assert buffer.drain(2)[0] == [1, 2]
+    fill(buffer, [4, 5, 6])  # wraps around the end of the arrays
+    assert len(buffer) == 4
+    assert buffer.dropped == 0
+    times, values = buffer.drain(3)
+    assert times == [3, 4, 5]
+    assert values["current"] == [30, 40, 50]
+    assert buffer.drain(10)[0] == [6]
+    assert buffer.drain() == ([], {"current": [], "rf_amp": []})
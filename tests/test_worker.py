@@ -0,0 +1,149 @@
+from threading import Event
+from time import monotonic, sleep
+
+import pytest
+
+from qsource3_mqtt.qsource3_worker import QSource3Worker
+
+
+def test_run_pending_without_time_left_runs_the_queued_jobs():
+    worker = QSource3Worker()  # not started, the test thread runs the jobs
+    ran = []
+    worker.submit(ran.append, 1)
+    worker.submit(ran.append, 2)
+    worker.run_pending(0.0)
+    assert ran == [1, 2]
+    worker.submit(ran.append, 3)
+    worker.run_pending(-1.0)
+    assert ran == [1, 2, 3]
+
+
+def test_run_pending_without_time_left_does_not_run_later_jobs():
+    worker = QSource3Worker()
+    ran = []
+    worker.submit(lambda: worker.submit(ran.append, "later"))
+    worker.run_pending(0.0)
+    assert ran == []
+    assert worker.pending() == 1
+
+
+def test_run_pending_stops_at_the_stop_event():
+    worker = QSource3Worker()
+    stop_event = Event()
+    ran = []
+    worker.submit(stop_event.set)
+    worker.submit(ran.append, 1)
+    worker.run_pending(0.0, stop_event)
+    assert ran == []
+    assert worker.pending() == 1
+
+
+def wait_until(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline, "timed out"
+        sleep(0.001)
+
+
+def test_idle_job_runs_only_while_no_job_is_queued():
+    calls = []
+
+    def idle():
+        calls.append(monotonic())
+        return 0.001
+
+    worker = QSource3Worker(idle=idle)
+    worker.start()
+    try:
+        wait_until(lambda: len(calls) >= 3)
+        release = Event()
+        started = Event()
+        worker.submit(lambda: (started.set(), release.wait(5)))
+        started.wait(5)
+        count = len(calls)
+        sleep(0.05)
+        assert len(calls) == count  # not while the job runs
+        release.set()
+        wait_until(lambda: len(calls) > count)
+    finally:
+        worker.stop(5)
+
+
+def test_idle_job_waits_the_delay_it_returns_unless_a_job_arrives():
+    calls = []
+
+    def idle():
+        calls.append(monotonic())
+        return 10.0
+
+    worker = QSource3Worker(idle=idle)
+    worker.start()
+    try:
+        wait_until(lambda: len(calls) == 1)
+        sleep(0.05)
+        assert len(calls) == 1
+        worker.submit(lambda: None)
+        wait_until(lambda: len(calls) == 2)  # called again after the job
+    finally:
+        worker.stop(5)
+
+
+def record(calls, name):
+    def job(payload, superseded=()):
+        calls.append((name, payload, list(superseded)))
+
+    return job
+
+
+def test_coalesced_jobs_are_merged_across_reads():
+    worker = QSource3Worker()
+    calls = []
+    mz = record(calls, "mz")
+    worker.submit_coalesced("mz", mz, 10)
+    worker.submit_read(calls.append, "status")
+    worker.submit_coalesced("mz", mz, 20)
+    worker.submit_read(calls.append, "query")
+    worker.submit_coalesced("mz", mz, 30)
+    assert worker.coalesced == 2
+    worker.run_pending(0.0)
+    assert calls == [("mz", 30, [10, 20]), "status", "query"]
+
+
+@pytest.mark.parametrize(
+    "between",
+    [
+        lambda worker, calls: worker.submit(calls.append, "scan"),
+        lambda worker, calls: worker.submit_coalesced(
+            "range", record(calls, "range"), 1
+        ),
+    ],
+)
+def test_coalesced_jobs_are_not_merged_across_writes(between):
+    worker = QSource3Worker()
+    calls = []
+    mz = record(calls, "mz")
+    worker.submit_coalesced("mz", mz, 10)
+    between(worker, calls)
+    worker.submit_coalesced("mz", mz, 20)
+    worker.submit_coalesced("mz", mz, 30)
+    assert worker.coalesced == 1
+    worker.run_pending(0.0)
+    assert calls[0] == ("mz", 10, [])
+    assert calls[-1] == ("mz", 30, [20])
+
+
+def test_running_job_is_not_merged_into():
+    worker = QSource3Worker()
+    calls = []
+    mz = record(calls, "mz")
+
+    def first(payload, superseded=()):
+        # queued while the first job runs
+        worker.submit_coalesced("mz", mz, 20)
+        mz(payload, superseded)
+
+    worker.submit_coalesced("mz", first, 10)
+    worker.run_pending(0.0)
+    worker.run_pending(0.0)
+    assert calls == [("mz", 10, []), ("mz", 20, [])]
+    assert worker.coalesced == 0
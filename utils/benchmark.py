@@ -0,0 +1,159 @@
+"""Throughput and latency benchmark of QSource3MQTTClient on the simulated driver.
+
+Measures command throughput, command -> response latency percentiles,
+status publish cost or jitter and reconnect time. Without --broker the
+client is driven in-process through LoopbackMQTTClient, with --broker it
+runs its normal runtime against a real broker.
+
+Usage:
+    python utils/benchmark.py config.yaml --latency 5 --count 500
+    python utils/benchmark.py config.yaml --broker localhost:1883 --output bench.json
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+from harness import BrokerTarget, LoopbackTarget, latency_summary, make_config
+
+
+def bench_latency(target, count):
+    """Sends `count` mz writes one at a time, each waiting for its response."""
+    tracker = target.tracker
+    tracker.latencies.clear()
+    start = time.perf_counter()
+    for idx in range(count):
+        target.send("mz", tracker.new_payload(10 + idx % 100))
+        tracker.wait(10)
+    elapsed = time.perf_counter() - start
+    return {
+        "commands_per_s": round(count / elapsed, 1),
+        "latency": latency_summary(tracker.latencies),
+        "unanswered": tracker.drop_outstanding(),
+    }
+
+
+def bench_burst(target, count):
+    """Sends `count` mz writes without waiting, the device merges queued writes."""
+    tracker = target.tracker
+    tracker.latencies.clear()
+    coalesced = target.device.worker.coalesced
+    start = time.perf_counter()
+    for idx in range(count):
+        target.send("mz", tracker.new_payload(10 + idx % 100))
+    tracker.wait(60)
+    elapsed = time.perf_counter() - start
+    return {
+        "commands_per_s": round(count / elapsed, 1),
+        "latency": latency_summary(tracker.latencies),
+        "coalesced": target.device.worker.coalesced - coalesced,
+        "unanswered": tracker.drop_outstanding(),
+    }
+
+
+def bench_status_cost(target, count):
+    """Measures the duration of `count` status publishes on the device worker."""
+    device = target.device
+    durations = []
+    for _ in range(count):
+        start = time.perf_counter()
+        device.worker.call(device.publish_status).result()
+        durations.append(time.perf_counter() - start)
+    return latency_summary(durations)
+
+
+def bench_status_jitter(target, duration):
+    """Measures the intervals between status messages received over `duration` seconds."""
+    time.sleep(1)  # let the broker deliver the backlog of the previous tests
+    target.status_times.clear()
+    time.sleep(duration)
+    times = list(target.status_times)
+    intervals = [b - a for a, b in zip(times, times[1:])]
+    if len(intervals) < 2:
+        return {"messages": len(times)}
+    return {
+        "messages": len(times),
+        "mean_interval_ms": round(statistics.mean(intervals) * 1000, 3),
+        "jitter_ms": round(statistics.stdev(intervals) * 1000, 3),
+        "max_interval_ms": round(max(intervals) * 1000, 3),
+    }
+
+
+def bench_reconnect(target, count):
+    """Drops the device connection `count` times and measures the recovery."""
+    device = target.device
+    tracker = target.tracker
+    tracker.latencies.clear()
+    connect_durations = []
+
+    def drop_connection():
+        device.qsource3._is_connected = False
+
+    for _ in range(count):
+        device.worker.call(drop_connection).result()
+        target.send("mz", tracker.new_payload())
+        tracker.wait(10)
+        duration = device.qsource3.connect_metrics.get("duration")
+        if duration is not None:
+            connect_durations.append(duration)
+    return {
+        "command_latency": latency_summary(tracker.latencies),
+        "connect": latency_summary(connect_durations),
+        "unanswered": tracker.drop_outstanding(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("config", nargs="?", default="config.yaml")
+    parser.add_argument(
+        "--latency", type=float, default=5, help="simulated serial latency in ms"
+    )
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--broker", help="host:port of a broker, in-process if omitted")
+    parser.add_argument("--status-interval", type=int, default=100)
+    parser.add_argument("--runtime", choices=("select", "asyncio"), default="select")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    overrides = {"status_interval": args.status_interval, "runtime": args.runtime}
+    if args.broker:
+        overrides["mqtt_broker"], _, port = args.broker.partition(":")
+        overrides["mqtt_port"] = int(port or 1883)
+    config_path = make_config(args.config, args.latency, args.failure_rate, overrides)
+
+    if args.broker:
+        target = BrokerTarget(config_path, args.broker)
+    else:
+        target = LoopbackTarget(config_path)
+
+    report = {
+        "mode": f"broker {args.broker} ({args.runtime})" if args.broker else "loopback",
+        "serial_latency_ms": args.latency,
+        "failure_rate": args.failure_rate,
+    }
+    try:
+        target.send("range", target.tracker.new_payload())  # connect the device
+        target.tracker.wait(30)
+        target.tracker.drop_outstanding()
+
+        report["latency"] = bench_latency(target, args.count)
+        report["burst"] = bench_burst(target, args.count)
+        report["status_cost"] = bench_status_cost(target, min(args.count, 100))
+        if args.broker:
+            report["status_jitter"] = bench_status_jitter(target, 5)
+        report["reconnect"] = bench_reconnect(target, min(args.count, 20))
+        report["errors"] = target.tracker.errors
+    finally:
+        target.close()
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Helpers shared by the benchmark and soak test tools.
+
+The tools run QSource3MQTTClient against the simulated QSource3 driver and
+either an in-process broker stand-in (LoopbackMQTTClient) or a real broker.
+"""
+
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt
+import yaml
+
+# make the qsource3_mqtt package importable when run as `python utils/<tool>.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qsource3_mqtt.qsource3_codec import decode  # noqa: E402
+from qsource3_mqtt.qsource3_mqtt_client import QSource3MQTTClient  # noqa: E402
+
+
+class LoopbackMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class LoopbackMessageInfo:
+    rc = 0  # MQTT_ERR_SUCCESS
+
+
+class LoopbackMQTTClient:
+    """In-process stand-in for the paho client used by QSource3MQTTClient.
+
+    Publishes are handed synchronously to `on_publish(topic, payload)`,
+    `inject` delivers a command as if it came from the broker.
+    """
+
+    def __init__(self, gateway, on_publish=None):
+        self.gateway = gateway
+        self.on_publish = on_publish
+        self.connected = True
+        self.published = 0
+
+    def is_connected(self):
+        return self.connected
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        if self.on_publish is not None:
+            self.on_publish(topic, payload)
+        return LoopbackMessageInfo()
+
+    def inject(self, topic, payload):
+        self.gateway.on_message(self, None, LoopbackMessage(topic, payload))
+
+
+class ResponseTracker:
+    """Matches responses to commands by the `id` field of their sender payload."""
+
+    def __init__(self):
+        self._ids = itertools.count()
+        self._sent = {}
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self.latencies = []
+        self.errors = 0
+
+    def new_payload(self, value=None):
+        payload = {"id": next(self._ids)}
+        if value is not None:
+            payload["value"] = value
+        with self._lock:
+            self._sent[payload["id"]] = time.perf_counter()
+        return payload
+
+    def on_publish(self, topic, payload):
+        if "/error/" in topic:
+            with self._lock:
+                self.errors += 1
+            return
+        if "/response/" not in topic:
+            return
+        sender = decode(payload).get("sender_payload", {})
+        now = time.perf_counter()
+        with self._lock:
+            sent = self._sent.pop(sender.get("id"), None)
+            if sent is not None:
+                self.latencies.append(now - sent)
+            self._done.notify_all()
+
+    def outstanding(self):
+        with self._lock:
+            return len(self._sent)
+
+    def wait(self, timeout):
+        """Waits until all commands are answered, returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._sent:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._done.wait(remaining)
+        return True
+
+    def take_latencies(self):
+        """Returns and clears the latencies measured so far."""
+        with self._lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+    def expire(self, timeout):
+        """Forgets commands unanswered for more than `timeout` seconds and returns their number."""
+        deadline = time.perf_counter() - timeout
+        with self._lock:
+            expired = [id_ for id_, sent in self._sent.items() if sent < deadline]
+            for id_ in expired:
+                del self._sent[id_]
+        return len(expired)
+
+    def drop_outstanding(self):
+        """Forgets unanswered commands and returns their number."""
+        with self._lock:
+            count = len(self._sent)
+            self._sent.clear()
+            return count
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def latency_summary(latencies):
+    """Returns count and percentiles in milliseconds of `latencies` given in seconds."""
+    summary = {"count": len(latencies)}
+    for p in (50, 90, 99):
+        value = percentile(latencies, p)
+        summary[f"p{p}_ms"] = None if value is None else round(value * 1000, 3)
+    summary["max_ms"] = round(max(latencies) * 1000, 3) if latencies else None
+    return summary
+
+
+def make_config(config_file, latency, failure_rate, overrides=None):
+    """Writes a copy of `config_file` using the simulated driver and returns its path."""
+    with open(config_file, "r") as file:
+        config = yaml.safe_load(file)
+    config["simulator"] = {"latency": latency, "failure_rate": failure_rate}
+    config.pop("devices", None)
+    config.update(overrides or {})
+    directory = tempfile.mkdtemp(prefix="qsource3-bench-")
+    config["settings_file"] = os.path.join(directory, "settings.json")
+    path = os.path.join(directory, "config.yaml")
+    with open(path, "w") as file:
+        yaml.safe_dump(config, file)
+    return path
+
+
+def make_loopback_gateway(config_path, tracker):
+    gateway = QSource3MQTTClient(config_path)
+    gateway.client = LoopbackMQTTClient(gateway, tracker.on_publish)
+    return gateway
+
+
+class LoopbackTarget:
+    """Drives the client in-process through LoopbackMQTTClient."""
+
+    def __init__(self, config_path):
+        self.tracker = ResponseTracker()
+        self.gateway = make_loopback_gateway(config_path, self.tracker)
+        self.topic_base = self.gateway.topic_base
+        self.device = next(iter(self.gateway.devices.values()))
+
+    def send(self, command, payload):
+        topic = f"{self.topic_base}/cmnd/{self.device.device_name}/{command}"
+        self.gateway.client.inject(topic, json.dumps(payload))
+
+    def close(self):
+        self.gateway.stop()
+
+
+class BrokerTarget:
+    """Runs the client against a real broker, `forever` reconnects after a broker outage."""
+
+    def __init__(self, config_path, broker, forever=False):
+        host, _, port = broker.partition(":")
+        self.tracker = ResponseTracker()
+        self.status_times = deque(maxlen=10000)
+        self.gateway = QSource3MQTTClient(config_path)
+        self.topic_base = self.gateway.topic_base
+        self.device = next(iter(self.gateway.devices.values()))
+        run = self.gateway.run_forever if forever else self.gateway.run
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+        self.observer = mqtt.Client()
+        self.observer.on_connect = self.on_connect
+        self.observer.on_message = self.on_message
+        self.observer.connect(host, int(port or 1883))
+        self.observer.loop_start()
+        time.sleep(1)  # let both clients connect and subscribe
+
+    def on_connect(self, client, userdata, flags, reason_code):
+        # subscribed again after each reconnect of the clean session
+        client.subscribe(f"{self.topic_base}/#")
+
+    def on_message(self, client, userdata, msg):
+        if msg.topic.endswith("/state"):
+            self.status_times.append(time.perf_counter())
+        else:
+            self.tracker.on_publish(msg.topic, msg.payload)
+
+    def send(self, command, payload):
+        topic = f"{self.topic_base}/cmnd/{self.device.device_name}/{command}"
+        self.observer.publish(topic, json.dumps(payload))
+
+    def close(self):
+        self.gateway.stop()
+        self.thread.join(5)
+        self.observer.loop_stop()
+        self.observer.disconnect()
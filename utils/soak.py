@@ -0,0 +1,236 @@
+"""Load and soak test of QSource3MQTTClient on the simulated driver.
+
+Fires a weighted mix of commands at a target rate for a long time and
+reports, per time window, the memory (RSS) of the process, the command ->
+response latency percentiles, the responses not received within
+--response-timeout, the backlog of the device queue and the outbox and the
+device and broker reconnects. The JSON report can be compared between
+releases. Without --broker the client is driven in-process through
+LoopbackMQTTClient, with --broker it runs its normal runtime (reconnecting
+after broker outages) against a real broker.
+
+Usage:
+    python utils/soak.py config.yaml --duration 14400 --rate 200 --output soak.json
+    python utils/soak.py config.yaml --mix mz=8,max_mz=1,calib_pnts_dc=1 --drop-interval 60
+    python utils/soak.py config.yaml --broker localhost:1883 --runtime asyncio
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import time
+
+from harness import BrokerTarget, LoopbackTarget, latency_summary, make_config
+
+# command -> value of a write (from a random.Random), None sends a query
+COMMAND_VALUES = {
+    "mz": lambda rng: round(rng.uniform(10, 100), 2),
+    "dc_offst": lambda rng: round(rng.uniform(-5, 5), 2),
+    "is_dc_on": lambda rng: rng.random() < 0.5,
+    "range": lambda rng: rng.randrange(2),
+    "max_mz": None,
+    "calib_pnts_dc": None,
+    "calib_pnts_rf": None,
+    "is_rod_polarity_positive": None,
+    "batch": None,
+}
+
+DEFAULT_MIX = "mz=8,max_mz=1,calib_pnts_dc=1,calib_pnts_rf=1,dc_offst=1"
+
+
+def parse_mix(text):
+    """Parses `name=weight,...` into a list of (command, weight)."""
+    mix = []
+    for entry in text.split(","):
+        name, _, weight = entry.strip().partition("=")
+        if name not in COMMAND_VALUES:
+            raise ValueError(f"Unknown command in mix: {name}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def rss_mb():
+    """Returns the resident set size of the process in MiB (the peak if unknown)."""
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except (OSError, ValueError):
+        # ru_maxrss is in KiB on Linux
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def soak(target, mix, rate, duration, window, response_timeout, drop_interval, seed):
+    """Sends commands for `duration` seconds and returns the statistics of each window."""
+    rng = random.Random(seed)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    tracker = target.tracker
+    device = target.device
+    gateway = target.gateway
+
+    def drop_connection():
+        device.qsource3._is_connected = False
+
+    windows = []
+    start = time.monotonic()
+    next_send = start
+    next_window = start + window
+    next_drop = start + drop_interval if drop_interval else None
+    sent = 0
+    while True:
+        now = time.monotonic()
+        end = now - start >= duration
+        if now >= next_window or end:
+            if end:
+                tracker.wait(response_timeout)  # the last window includes the tail
+            metrics = device.metrics.snapshot()
+            windows.append(
+                {
+                    "t_s": round(now - start, 1),
+                    "sent": sent,
+                    "latency": latency_summary(tracker.take_latencies()),
+                    "dropped": tracker.expire(response_timeout),
+                    "rss_mb": rss_mb(),
+                    "queue_depth": device.worker.pending(),
+                    "outbox": len(gateway.outbox),
+                    "device_reconnects": metrics["counters"].get("reconnects", 0),
+                    "broker_connects": gateway.broker_connects,
+                    "errors": tracker.errors,
+                }
+            )
+            print(json.dumps(windows[-1]), flush=True)
+            sent = 0
+            next_window += window
+            if end:
+                break
+
+        if next_drop is not None and now >= next_drop:
+            device.worker.submit(drop_connection)
+            next_drop += drop_interval
+
+        if now < next_send:
+            time.sleep(min(next_send, next_window) - now)
+            continue
+        name = rng.choices(names, weights)[0]
+        value = COMMAND_VALUES[name]
+        target.send(name, tracker.new_payload(None if value is None else value(rng)))
+        sent += 1
+        next_send += 1 / rate
+        if next_send < now - 1:
+            next_send = now  # the sender fell behind, do not catch up in a burst
+    return windows
+
+
+def summarize(windows, dropped_at_end):
+    first, last = windows[0], windows[-1]
+    return {
+        "sent": sum(w["sent"] for w in windows),
+        "answered": sum(w["latency"]["count"] for w in windows),
+        "dropped": sum(w["dropped"] for w in windows) + dropped_at_end,
+        "rss_mb_first": first["rss_mb"],
+        "rss_mb_last": last["rss_mb"],
+        "rss_mb_max": max(w["rss_mb"] for w in windows),
+        "p50_ms_first": first["latency"]["p50_ms"],
+        "p50_ms_last": last["latency"]["p50_ms"],
+        "p99_ms_first": first["latency"]["p99_ms"],
+        "p99_ms_last": last["latency"]["p99_ms"],
+        "p99_ms_max": max(
+            (w["latency"]["p99_ms"] for w in windows if w["latency"]["count"]),
+            default=None,
+        ),
+        "max_queue_depth": max(w["queue_depth"] for w in windows),
+        "max_outbox": max(w["outbox"] for w in windows),
+        "device_reconnects": last["device_reconnects"],
+        "broker_reconnects": max(0, last["broker_connects"] - 1),
+        "errors": last["errors"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("config", nargs="?", default="config.yaml")
+    parser.add_argument(
+        "--latency", type=float, default=2, help="simulated serial latency in ms"
+    )
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--duration", type=float, default=3600, help="test duration in seconds"
+    )
+    parser.add_argument("--rate", type=float, default=50, help="commands per second")
+    parser.add_argument(
+        "--mix", default=DEFAULT_MIX, help="weighted commands, e.g. mz=8,max_mz=1"
+    )
+    parser.add_argument(
+        "--window", type=float, default=60, help="statistics window in seconds"
+    )
+    parser.add_argument(
+        "--response-timeout",
+        type=float,
+        default=10,
+        help="seconds after which a missing response counts as dropped",
+    )
+    parser.add_argument(
+        "--drop-interval",
+        type=float,
+        default=0,
+        help="drop the device connection every this many seconds, 0 never",
+    )
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--broker", help="host:port of a broker, in-process if omitted")
+    parser.add_argument("--status-interval", type=int, default=1000)
+    parser.add_argument("--runtime", choices=("select", "asyncio"), default="select")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    overrides = {"status_interval": args.status_interval, "runtime": args.runtime}
+    if args.broker:
+        overrides["mqtt_broker"], _, port = args.broker.partition(":")
+        overrides["mqtt_port"] = int(port or 1883)
+    config_path = make_config(args.config, args.latency, args.failure_rate, overrides)
+
+    if args.broker:
+        target = BrokerTarget(config_path, args.broker, forever=True)
+    else:
+        target = LoopbackTarget(config_path)
+
+    report = {
+        "mode": f"broker {args.broker} ({args.runtime})" if args.broker else "loopback",
+        "serial_latency_ms": args.latency,
+        "failure_rate": args.failure_rate,
+        "rate": args.rate,
+        "mix": dict(mix),
+        "duration_s": args.duration,
+    }
+    try:
+        target.send("range", target.tracker.new_payload())  # connect the device
+        target.tracker.wait(30)
+        target.tracker.drop_outstanding()
+        target.tracker.take_latencies()
+
+        windows = soak(
+            target,
+            mix,
+            args.rate,
+            args.duration,
+            args.window,
+            args.response_timeout,
+            args.drop_interval,
+            args.seed,
+        )
+        report["summary"] = summarize(windows, target.tracker.drop_outstanding())
+        report["windows"] = windows
+    finally:
+        target.close()
+
+    print(json.dumps(report["summary"], indent=4))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()